@@ -0,0 +1,81 @@
+#
+# scoring_browser --- Simple Qt application for browsing
+# scoring outputs in Geant4
+#
+# Copyright (C) 2012-2014 Jan Pipek
+# (jan.pipek@gmail.com)
+#
+# This file may be distributed without limitation.
+#
+"""Compare the block parser with the original line-by-line loader.
+
+Usage:
+    python benchmarks/bench_csv_loader.py [size]
+
+A synthetic scoring file with size^3 voxels is written to a temporary
+directory and read by both loaders.
+"""
+import os
+import re
+import sys
+import shutil
+import tempfile
+import time
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..",
+                                "scoring_browser"))
+from data_matrix import DataMatrixLoader
+from synthetic import write_scoring_file
+
+
+def regex_from_csv(file_name):
+    """The original regex-based loader (as a reference)."""
+    with open(file_name) as f:
+        text = f.read()
+
+    points = []
+    linePattern = re.compile("(\d+),(\d+),(\d+),([0-9.e\-]*)")
+
+    for line in text.splitlines():
+        match = linePattern.match(line)
+        if match:
+            points.append([int(match.group(1)), int(match.group(2)),
+                           int(match.group(3)), float(match.group(4))])
+
+    sizeX = max(l[0] for l in points) + 1
+    sizeY = max(l[1] for l in points) + 1
+    sizeZ = max(l[2] for l in points) + 1
+
+    data_array = numpy.ndarray(shape=(sizeX, sizeY, sizeZ), dtype=float)
+    if len(points) != data_array.size:
+        raise Exception("Incomplete file.")
+    for p in points:
+        data_array[p[0], p[1], p[2]] = p[3]
+    return data_array
+
+
+def run(size):
+    directory = tempfile.mkdtemp()
+    try:
+        file_name = os.path.join(directory, "mesh.txt")
+        write_scoring_file(file_name, (size, size, size))
+
+        start = time.time()
+        reference = regex_from_csv(file_name)
+        regex_time = time.time() - start
+
+        start = time.time()
+        matrix = DataMatrixLoader.from_csv(file_name)
+        block_time = time.time() - start
+
+        assert numpy.array_equal(reference, matrix.data_array)
+        sys.stdout.write("%d^3 voxels: regex %.3f s, blocks %.3f s (%.1fx)\n"
+                         % (size, regex_time, block_time,
+                            regex_time / block_time))
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 100)
@@ -0,0 +1,55 @@
+#
+# scoring_browser --- Simple Qt application for browsing
+# scoring outputs in Geant4
+#
+# Copyright (C) 2012-2014 Jan Pipek
+# (jan.pipek@gmail.com)
+#
+# This file may be distributed without limitation.
+#
+"""Compare throughput of the JSON (1) and binary (2) net protocols.
+
+The binary protocol is measured also with zlib compression, both for
+random data and for a typical mesh (mostly zeros, rounded values).
+
+Usage:
+    python benchmarks/bench_net_protocol.py [size_in_MB] [repeats]
+"""
+import os
+import sys
+import time
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..",
+                                "scoring_browser"))
+import net
+
+PORT = 9780
+
+
+def run(megabytes, repeats):
+    server = net.Server(port=PORT)
+    server.start()
+    random = numpy.random.rand(megabytes * (1 << 20) // 8)
+    mesh = numpy.zeros_like(random)
+    mesh[:len(mesh) // 4] = random[:len(mesh) // 4].round(3)
+    for data_name, data in (("random", random), ("mesh", mesh)):
+        for protocol, compression in ((1, None), (2, None), (2, "zlib")):
+            client = net.Client(port=PORT, protocol=protocol,
+                                compression=compression)
+            start = time.time()
+            for i in range(repeats):
+                client.send(data)
+                received = server.pop_message()
+            elapsed = time.time() - start
+            client.close()
+            assert numpy.array_equal(received.data, data)
+            sys.stdout.write("%s, protocol %d, %s: %.1f MB/s\n"
+                             % (data_name, protocol, compression or "raw",
+                                megabytes * repeats / elapsed))
+    server.stop()
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 64,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 5)
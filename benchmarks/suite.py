@@ -0,0 +1,371 @@
+#
+# scoring_browser --- Simple Qt application for browsing
+# scoring outputs in Geant4
+#
+# Copyright (C) 2012-2014 Jan Pipek
+# (jan.pipek@gmail.com)
+#
+# This file may be distributed without limitation.
+#
+"""Benchmark suite of loading, processing, transfer and display of matrices.
+
+Usage:
+    python benchmarks/suite.py run [--sizes 10 50 100] [-o results.json]
+    python benchmarks/suite.py compare old.json new.json [--threshold 0.25]
+
+Synthetic scoring files (text and HDF5) with size^3 voxels are generated
+for each size, both "dense" (random values) and "sparse" (1 % non-zero),
+see synthetic.py. They are kept in --data-dir (if given) and reused
+by the following runs.
+
+Each benchmark is repeated (--repeats) and the best and median times
+are written as JSON. The compare command flags benchmarks slower
+than before by more than the threshold (and exits with 1 if there
+are any).
+
+The views (table, chart) need PyQt4 and a display; the windows are never
+shown (use e.g. xvfb-run on servers). Benchmarks whose requirements are
+missing are recorded as skipped.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import collections
+import timeit
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..",
+                                "scoring_browser"))
+from data_matrix import DataMatrixLoader, DataMatrixSlice2D, HDF5_ENABLED
+from synthetic import (random_values, write_scoring_file, write_hdf5_file,
+                       SPARSE_DENSITY)
+
+DEFAULT_SIZES = (10, 50, 100)
+
+KINDS = ("dense", "sparse")
+
+# Port of the server in the network benchmarks
+PORT = 9781
+
+# Slices sampled along each axis
+SLICE_SAMPLES = 32
+
+# Differences below this (in seconds) are never regressions
+NOISE_FLOOR = 0.002
+
+
+class Skipped(Exception):
+    """Requirements of a benchmark are missing."""
+    pass
+
+
+class BenchmarkData(object):
+    """Files and the loaded matrix of one (size, kind)."""
+    def __init__(self, directory, size, kind):
+        self.size = size
+        self.kind = kind
+        self.shape = (size, size, size)
+        base = os.path.join(directory, "mesh_%s_%d" % (kind, size))
+        self.text_file = base + ".txt"
+        self.hdf5_file = base + ".h5"
+        self.values = None
+        self.cleanups = []
+        self._matrix = None
+
+    def generate(self):
+        """Write the files (unless they exist already)."""
+        density = SPARSE_DENSITY if self.kind == "sparse" else 1.0
+        self.values = random_values(self.shape, density)
+        if not os.path.exists(self.text_file):
+            write_scoring_file(self.text_file, values=self.values)
+        if HDF5_ENABLED and not os.path.exists(self.hdf5_file):
+            write_hdf5_file(self.hdf5_file, self.values)
+
+    @property
+    def matrix(self):
+        """Matrix as the loader would create it (sparse if worth it)."""
+        if self._matrix is None:
+            self._matrix = DataMatrixLoader.matrix_from_array(self.values)
+        return self._matrix
+
+    def samples(self, axis):
+        """Indices of slices sampled along an axis."""
+        return sorted(set(numpy.linspace(0, self.shape[axis] - 1,
+                                         SLICE_SAMPLES).astype(int)))
+
+    def cleanup(self):
+        while self.cleanups:
+            self.cleanups.pop()()
+
+
+# Benchmarks by name: functions of BenchmarkData returning the
+# function to be timed (raising Skipped if not possible)
+BENCHMARKS = collections.OrderedDict()
+
+
+def benchmark(name):
+    def register(function):
+        BENCHMARKS[name] = function
+        return function
+    return register
+
+
+@benchmark("load_csv")
+def load_csv(data):
+    def run():
+        DataMatrixLoader.from_csv(data.text_file).close()
+    return run
+
+
+@benchmark("load_hdf5")
+def load_hdf5(data):
+    if not HDF5_ENABLED:
+        raise Skipped("h5py not installed")
+
+    def run():
+        # The matrix reads the dataset lazily
+        matrix = DataMatrixLoader.from_hdf5(data.hdf5_file, "data")
+        matrix.max_value
+        matrix.close()
+    return run
+
+
+@benchmark("reduced")
+def reduced(data):
+    def run():
+        data.matrix.reduced((2, 2, 2), "sum", "pad")
+    return run
+
+
+@benchmark("relative_slices")
+def relative_slices(data):
+    def run():
+        for index in data.samples(2):
+            data.matrix[:, :, index, True]
+    return run
+
+
+@benchmark("slices")
+def slices(data):
+    def run():
+        for axis in range(3):
+            for index in data.samples(axis):
+                numpy.ascontiguousarray(
+                    DataMatrixSlice2D(data.matrix, axis, index).data)
+    return run
+
+
+def _message_round_trip(data, compression):
+    try:
+        import net
+    except ImportError:
+        raise Skipped("pyzmq not installed")
+
+    message = net.Message("bench", data.values)
+
+    def run():
+        frames = message.as_frames(compression)
+        received = net.Message.from_frames(frames)
+        numpy.ascontiguousarray(received.data)
+    return run
+
+
+@benchmark("message_raw")
+def message_raw(data):
+    return _message_round_trip(data, None)
+
+
+@benchmark("message_zlib")
+def message_zlib(data):
+    return _message_round_trip(data, "zlib")
+
+
+@benchmark("net_send")
+def net_send(data):
+    try:
+        import net
+    except ImportError:
+        raise Skipped("pyzmq not installed")
+    server = net.Server(port=PORT)
+    server.start()
+    client = net.Client(port=PORT)
+    data.cleanups.append(server.stop)
+    data.cleanups.append(client.close)
+
+    def run():
+        client.send(data.values)
+        server.pop_message()
+    return run
+
+
+_window = None
+
+
+def _application_window():
+    """Hidden application window (created once)."""
+    global _window
+    if _window is None:
+        if sys.platform.startswith("linux") and not os.environ.get("DISPLAY"):
+            raise Skipped("no display")
+        try:
+            from PyQt4 import QtGui
+            from qt4_ui import ApplicationWindow
+        except ImportError:
+            raise Skipped("PyQt4 not installed")
+        app = QtGui.QApplication.instance() or QtGui.QApplication(sys.argv)
+        _window = ApplicationWindow()
+        _window.app = app
+    return _window
+
+
+def _view_refresh(data, tab_name):
+    window = _application_window()
+    tab = getattr(window, tab_name, None)
+    if tab is None:
+        raise Skipped("%s not available" % tab_name)
+    window.set_matrix(data.matrix)
+    data.cleanups.append(lambda: window.set_matrix(None))
+
+    def run():
+        for index in data.samples(2):
+            tab.slice_index = index
+            window.app.processEvents()
+    return run
+
+
+@benchmark("table_refresh")
+def table_refresh(data):
+    return _view_refresh(data, "tableTab")
+
+
+@benchmark("chart_refresh")
+def chart_refresh(data):
+    return _view_refresh(data, "chartTab")
+
+
+def measure(function, repeats):
+    """Best and median time of repeated calls."""
+    times = []
+    for i in range(repeats):
+        start = timeit.default_timer()
+        function()
+        times.append(timeit.default_timer() - start)
+    return min(times), float(numpy.median(times))
+
+
+def run_suite(args):
+    directory = args.data_dir or tempfile.mkdtemp()
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    names = args.benchmarks or list(BENCHMARKS)
+    results = []
+    try:
+        for size in args.sizes:
+            for kind in args.kinds:
+                data = BenchmarkData(directory, size, kind)
+                sys.stderr.write("generating %s %d^3...\n" % (kind, size))
+                data.generate()
+                for name in names:
+                    result = {"name": name, "size": size, "kind": kind}
+                    try:
+                        function = BENCHMARKS[name](data)
+                        result["best"], result["median"] = measure(
+                            function, args.repeats)
+                        sys.stderr.write("  %-16s %10.4f s\n"
+                                         % (name, result["best"]))
+                    except Skipped as exc:
+                        result["skipped"] = str(exc)
+                        sys.stderr.write("  %-16s skipped (%s)\n"
+                                         % (name, exc))
+                    finally:
+                        data.cleanup()
+                    results.append(result)
+    finally:
+        if not args.data_dir:
+            shutil.rmtree(directory)
+
+    report = {
+        "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": numpy.__version__,
+        "platform": platform.platform(),
+        "repeats": args.repeats,
+        "results": results
+    }
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        sys.stdout.write(text + "\n")
+    return 0
+
+
+def compare(args):
+    """Print the ratios of times of two runs.
+
+    :returns: number of regressions
+    """
+    def load(file_name):
+        with open(file_name) as f:
+            results = json.load(f)["results"]
+        return collections.OrderedDict(
+            ((r["name"], r["size"], r["kind"]), r) for r in results
+            if "best" in r)
+
+    old, new = load(args.old), load(args.new)
+    regressions = 0
+    for key, result in new.items():
+        if key not in old:
+            continue
+        before, after = old[key]["best"], result["best"]
+        ratio = after / before if before else float("inf")
+        regression = (after > before * (1 + args.threshold) and
+                      after - before > NOISE_FLOOR)
+        regressions += regression
+        sys.stdout.write("%-16s %4d %-6s %10.4f %10.4f %6.2fx%s\n"
+                         % (key + (before, after, ratio,
+                                   "  REGRESSION" if regression else "")))
+    return regressions
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        description="Benchmarks of scoring_browser.")
+    subparsers = parser.add_subparsers(dest="command")
+
+    sub = subparsers.add_parser("run", help="run the benchmarks")
+    sub.add_argument("--sizes", type=int, nargs="+",
+                     default=list(DEFAULT_SIZES),
+                     help="edges of the matrices (up to 500)")
+    sub.add_argument("--kinds", nargs="+", default=list(KINDS),
+                     choices=KINDS)
+    sub.add_argument("--benchmarks", nargs="+", choices=list(BENCHMARKS))
+    sub.add_argument("--repeats", type=int, default=3)
+    sub.add_argument("--data-dir", default=None,
+                     help="directory keeping the generated files")
+    sub.add_argument("-o", "--output", default=None,
+                     help="JSON file (default: standard output)")
+
+    sub = subparsers.add_parser("compare", help="compare two runs")
+    sub.add_argument("old")
+    sub.add_argument("new")
+    sub.add_argument("--threshold", type=float, default=0.25,
+                     help="relative slowdown considered a regression")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.command == "run":
+        return run_suite(args)
+    return 1 if compare(args) else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,62 @@
+#
+# scoring_browser --- Simple Qt application for browsing
+# scoring outputs in Geant4
+#
+# Copyright (C) 2012-2014 Jan Pipek
+# (jan.pipek@gmail.com)
+#
+# This file may be distributed without limitation.
+#
+"""Synthetic scoring data for the benchmarks.
+
+The data are reproducible (generated with a fixed seed).
+"""
+import numpy
+
+# Fraction of non-zero voxels in "sparse" data
+SPARSE_DENSITY = 0.01
+
+# Planes of the matrix written at once
+_BLOCK_VOXELS = 1 << 20
+
+
+def random_values(shape, density=1.0, seed=0):
+    """Exponentially distributed values, the rest of the voxels are zero.
+
+    :param density: fraction of non-zero voxels
+    """
+    random = numpy.random.RandomState(seed)
+    values = random.exponential(size=shape)
+    if density < 1.0:
+        values[random.random_sample(shape) >= density] = 0.0
+    return values
+
+
+def write_scoring_file(file_name, shape=None, values=None, density=1.0,
+                       seed=0):
+    """Write a random matrix (or values) in the Geant4 scoring format.
+
+    :returns: the values
+    """
+    if values is None:
+        values = random_values(shape, density, seed)
+    shape = values.shape
+    step = max(1, _BLOCK_VOXELS // (shape[1] * shape[2]))
+    with open(file_name, "w") as f:
+        f.write("# mesh name: boxMesh_1\n")
+        f.write("# primitive scorer name: eDep\n")
+        f.write("# iX, iY, iZ, value [MeV]\n")
+        for x0 in range(0, shape[0], step):
+            block = values[x0:x0 + step]
+            indices = numpy.indices(block.shape).reshape(3, -1)
+            indices[0] += x0
+            numpy.savetxt(f, numpy.column_stack((indices.T, block.ravel())),
+                          fmt="%d,%d,%d,%.6g")
+    return values
+
+
+def write_hdf5_file(file_name, values, dataset="data"):
+    """Write values as a (chunked) dataset of an HDF5 file."""
+    import h5py
+    with h5py.File(file_name, "w") as f:
+        f.create_dataset(dataset, data=values, chunks=True)
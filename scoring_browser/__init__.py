@@ -8,5 +8,12 @@
 # This file may be distributed without limitation.
 #
 from data_matrix import DataMatrix, DataMatrixSlice2D, DataMatrixLoader
-from qt4_ui import ApplicationWindow
-import net
+from data_matrix import H5DataMatrix, SparseDataMatrix, LoadCancelled
+from data_matrix import ScoringFileTail, ReloadNeeded
+
+# The GUI is not imported here (python -m scoring_browser runs without Qt),
+# use qt4_ui.ApplicationWindow (see main.pyw). The network part is optional.
+try:
+    import net
+except ImportError:
+    pass
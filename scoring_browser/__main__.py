@@ -0,0 +1,15 @@
+#
+# scoring_browser --- Simple Qt application for browsing
+# scoring outputs in Geant4
+#
+# Copyright (C) 2012-2014 Jan Pipek
+# (jan.pipek@gmail.com)
+#
+# This file may be distributed without limitation.
+#
+"""Batch processing without the GUI: python -m scoring_browser --help"""
+import sys
+
+from scoring_browser.cli import main
+
+sys.exit(main())
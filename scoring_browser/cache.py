@@ -0,0 +1,181 @@
+#
+# scoring_browser --- Simple Qt application for browsing
+# scoring outputs in Geant4
+#
+# Copyright (C) 2012-2014 Jan Pipek
+# (jan.pipek@gmail.com)
+#
+# This file may be distributed without limitation.
+#
+import os
+import json
+import hashlib
+import numpy
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache",
+                                 "scoring_browser")
+
+
+class SidecarCache(object):
+    """Cache of parsed scoring files stored as binary .npy files.
+
+    Each entry consists of <key>.npy with the data array and <key>.json
+    with the header and information about the source file (and anything
+    the caller wants to keep with the array, e.g. its format). The key is
+    derived from the absolute path, size, modification time and a hash
+    of the file content, so a changed file is never read from the cache.
+
+    Cached arrays are memory-mapped (read-only) when loaded, i.e. they
+    are available immediately and the pages are shared by the OS.
+
+    Total size of the .npy files is kept under max_size by removing
+    the least recently used entries.
+    """
+    # Size of the file parts (start, middle, end) included in the hash
+    SAMPLE_SIZE = 1 << 20
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_size=2 << 30,
+                 min_file_size=1 << 20):
+        '''
+        :param directory: Where to put the cache files.
+        :param max_size: Maximum total size of cached arrays (in bytes).
+        :param min_file_size: Smaller source files are not cached.
+        '''
+        self.directory = directory
+        self.max_size = max_size
+        self.min_file_size = min_file_size
+
+    def key(self, file_name):
+        """Cache key of a file (a hex string).
+
+        The content hash is computed from three samples of the file
+        (start, middle and end) so that it takes milliseconds even for
+        multi-gigabyte files.
+        """
+        file_name = os.path.abspath(file_name)
+        stat = os.stat(file_name)
+        digest = hashlib.sha1()
+        digest.update(("%s\n%d\n%r\n" % (file_name, stat.st_size,
+                                         stat.st_mtime)).encode("utf-8"))
+        with open(file_name, "rb") as f:
+            for position in (0, stat.st_size // 2,
+                             stat.st_size - self.SAMPLE_SIZE):
+                f.seek(max(0, position))
+                digest.update(f.read(self.SAMPLE_SIZE))
+        return digest.hexdigest()
+
+    def _paths(self, key):
+        base = os.path.join(self.directory, key)
+        return base + ".npy", base + ".json"
+
+    def load(self, file_name):
+        """Memory-mapped array and metadata of a cached file.
+
+        :returns: (data_array, metadata) or None if not in the cache;
+            the metadata contain the header and the info given to store
+        """
+        if os.path.getsize(file_name) < self.min_file_size:
+            return None
+        array_path, meta_path = self._paths(self.key(file_name))
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            data_array = numpy.load(array_path, mmap_mode="r")
+        except (IOError, OSError, ValueError):
+            return None
+        os.utime(meta_path, None)    # Mark as recently used
+        meta.setdefault("header", "")
+        return data_array, meta
+
+    def store(self, file_name, data_array, header="", **info):
+        """Put a parsed array into the cache.
+
+        Older entries for the same file are removed.
+
+        :param info: additional (JSON-serializable) metadata
+        """
+        if os.path.getsize(file_name) < self.min_file_size:
+            return
+        if data_array.nbytes > self.max_size:
+            return
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        key = self.key(file_name)
+        array_path, meta_path = self._paths(key)
+        meta = {
+            "file_name": os.path.abspath(file_name),
+            "header": header,
+            "shape": list(data_array.shape),
+            "dtype": str(data_array.dtype)
+        }
+        meta.update(info)
+        # Write to temporary files first, a half-written entry must not
+        # be loaded by another instance of the application.
+        with open(array_path + ".tmp", "wb") as f:
+            numpy.save(f, data_array)
+        with open(meta_path + ".tmp", "w") as f:
+            json.dump(meta, f)
+        self._replace(array_path + ".tmp", array_path)
+        self._replace(meta_path + ".tmp", meta_path)
+
+        for entry_key, entry_meta in self.entries():
+            if (entry_key != key and
+                    entry_meta.get("file_name") == meta["file_name"]):
+                self.remove(entry_key)
+        self.evict()
+
+    @staticmethod
+    def _replace(source, target):
+        if os.name == "nt" and os.path.exists(target):
+            os.remove(target)
+        os.rename(source, target)
+
+    def entries(self):
+        """All entries as (key, metadata) pairs."""
+        if not os.path.isdir(self.directory):
+            return []
+        result = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".json"):
+                try:
+                    with open(os.path.join(self.directory, name)) as f:
+                        result.append((name[:-5], json.load(f)))
+                except (IOError, ValueError):
+                    pass
+        return result
+
+    def remove(self, key):
+        for path in self._paths(key):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def clear(self):
+        """Remove all entries."""
+        for key, meta in self.entries():
+            self.remove(key)
+
+    @property
+    def size(self):
+        """Total size of the cached arrays (in bytes)."""
+        return sum(os.path.getsize(self._paths(key)[0])
+                   for key, meta in self.entries()
+                   if os.path.exists(self._paths(key)[0]))
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits."""
+        items = []
+        for key, meta in self.entries():
+            array_path, meta_path = self._paths(key)
+            try:
+                items.append((os.path.getmtime(meta_path),
+                              os.path.getsize(array_path), key))
+            except OSError:
+                self.remove(key)
+        total = sum(item[1] for item in items)
+        for used, size, key in sorted(items):
+            if total <= self.max_size:
+                break
+            self.remove(key)
+            total -= size
@@ -8,8 +8,10 @@
 # This file may be distributed without limitation.
 #
 from slice_tab import SliceTab
+from data_matrix import reduce_array
 
 from PyQt4 import QtGui, QtCore
+import copy
 import numpy as np
 import matplotlib
 import matplotlib.pyplot as plt
@@ -33,12 +35,45 @@ class ChartTab(SliceTab):
         self.toolBar.addWidget(self.threeDCheckBox)
 
         self.options = {
-            "contour_labels" : True
+            "contour_labels" : True,
+            "fast_rendering" : True    # 2D: image + delayed contours
         }
 
+        # Pyramid level used in the last drawing
+        self.level = 0
+
+        # Persistent artists of the fast 2D rendering
+        self.image = None
+        self._image_key = None
+        self._contour_data = None
+        self.contour_set = None
+        self.contour_labels = []
+
+        # 3D surface (drawn with fewer polygons while rotating)
+        self.surface = None
+        self.surface_factor = 1
+        self._surface_data = None
+        self._rotating = False
+
+        # Contours are drawn when the data stop changing
+        self.contour_timer = QtCore.QTimer(self)
+        self.contour_timer.setSingleShot(True)
+        self.contour_timer.setInterval(300)
+        self.contour_timer.timeout.connect(self.draw_contours)
+
+        # Redraw with another level after resizing / zooming (delayed)
+        self.refine_timer = QtCore.QTimer(self)
+        self.refine_timer.setSingleShot(True)
+        self.refine_timer.setInterval(200)
+        self.refine_timer.timeout.connect(self.update_chart)
+
         for signal in self.all_model_signals:
             signal.connect(self.update_chart)
+        self.slice_data_changed.connect(self.update_chart)
         self.threeDCheckBox.stateChanged.connect(self.on_3D_check_box_change)
+        self.canvas.mpl_connect("scroll_event", self.on_scroll)
+        self.canvas.mpl_connect("button_press_event", self.on_button_press)
+        self.canvas.mpl_connect("button_release_event", self.on_button_release)
 
         if hasattr(parent, "options_menu"):
             parent.options_menu.addAction('&Chart Options', self.show_options_dialog)   
@@ -51,8 +86,51 @@ class ChartTab(SliceTab):
 
     def on_3D_check_box_change(self, state):
         self.is_3d = (state == QtCore.Qt.Checked)
+        self.view_region = None
+        self.update_chart()
+
+    def max_display_shape(self):
+        # One element per pixel is enough
+        return (self.canvas.width(), self.canvas.height())
+
+    def resizeEvent(self, event):
+        SliceTab.resizeEvent(self, event)
+        if (self.matrix and not self.is_3d and
+                self.display_level() != self.level):
+            self.refine_timer.start()
+
+    def on_scroll(self, event):
+        """Zoom the 2D chart in/out around the mouse cursor."""
+        if self.is_3d or not self.matrix or event.inaxes is None:
+            return
+        factor = 0.8 if event.button == "up" else 1.25
+        full_region = [(-0.5, size - 0.5) for size in self.slice.shape]
+        region = self.view_region or full_region
+        centre = (event.xdata, event.ydata)
+        new_region = []
+        for (low, high), (full_low, full_high), c in zip(region, full_region,
+                                                         centre):
+            low = max(full_low, c - (c - low) * factor)
+            high = min(full_high, c + (high - c) * factor)
+            new_region.append((low, high))
+        if new_region == full_region:
+            self.view_region = None
+        else:
+            self.view_region = tuple(new_region)
         self.update_chart()
 
+    def on_button_press(self, event):
+        """Double click resets the zoom, 3D rotation uses a coarse surface."""
+        if self.is_3d:
+            if self.surface is not None and event.inaxes is self.axes:
+                budget = self.options.get("3d_polygon_budget", 20000)
+                self._rotating = True
+                self._draw_surface(max(100, budget // 10))
+                self.canvas.draw_idle()
+        elif getattr(event, "dblclick", False) and self.view_region:
+            self.view_region = None
+            self.update_chart()
+
     def _plot_2d(self, X, Y, Z):
         self.axes = self.figure.add_subplot(111)
 
@@ -67,6 +145,10 @@ class ChartTab(SliceTab):
         if self.options.get("contour_labels"):
             self.axes.clabel(cs, fontsize=9, inline=1)
 
+        if self.view_region:
+            self.axes.set_xlim(self.view_region[0])
+            self.axes.set_ylim(tuple(reversed(self.view_region[1])))
+
     def _plot_3d(self, X, Y, Z):
         self.axes = self.figure.add_subplot(111, projection='3d')
         
@@ -75,10 +157,8 @@ class ChartTab(SliceTab):
         azim = self.options.get("3dazim", -32.)
         self.axes.view_init(elev=elev, azim=azim)
 
-        plot = self.axes.plot_surface(X, Y, Z, rstride=1, cstride=1,
-                                 cmap=matplotlib.cm.coolwarm, linewidth=0,
-                                 vmin=np.nanmin(Z), vmax=np.nanmax(Z),
-                                 antialiased=True)
+        self._surface_data = (X, Y, Z)
+        plot = self._draw_surface(self.options.get("3d_polygon_budget", 20000))
         if self.options.get("3d_contours", False):
             contours = self.options.get("contours", 5)
             if np.any(~np.isnan(Z)):
@@ -88,28 +168,166 @@ class ChartTab(SliceTab):
         self.axes.set_xlabel(self.slice.plane_name[1])
         self.axes.set_ylabel(self.slice.plane_name[0])
 
+    def _draw_surface(self, budget):
+        """Plot the surface with at most (about) budget polygons.
+
+        If there are more elements, the surface is reduced in square
+        boxes using the "3d_reduction" option (nanmax by default,
+        so that peaks are kept). An existing surface is replaced.
+        """
+        X, Y, Z = self._surface_data
+        factor = int(np.ceil(np.sqrt(float(Z.size) / max(1, budget))))
+        if factor > 1:
+            method = self.options.get("3d_reduction", "nanmax")
+            X = reduce_array(X, (factor, factor), "mean", "pad")
+            Y = reduce_array(Y, (factor, factor), "mean", "pad")
+            Z = reduce_array(Z, (factor, factor), method, "pad")
+
+        if self.surface is not None:
+            self.surface.remove()
+        self.surface = self.axes.plot_surface(
+            X, Y, Z, rstride=1, cstride=1, cmap=matplotlib.cm.coolwarm,
+            linewidth=0, vmin=np.nanmin(self._surface_data[2]),
+            vmax=np.nanmax(self._surface_data[2]), antialiased=True)
+        self.surface_factor = factor
+        return self.surface
+
+    def on_button_release(self, event):
+        """Refine the 3D surface after rotation."""
+        if self.is_3d and self.surface is not None and self._rotating:
+            self._rotating = False
+            self._draw_surface(self.options.get("3d_polygon_budget", 20000))
+            self.canvas.draw_idle()
+
     def update_chart(self):
         # Keep 3D rotation
         if hasattr(self, "axes") and hasattr(self.axes, "elev"):
             self.options["3delev"] = self.axes.elev
             self.options["3dazim"] = self.axes.azim
 
-        self.figure.clear()
-        if self.matrix:
-            x = np.arange(self.slice.shape[1])
-            y = np.arange(self.slice.shape[0])
-            X, Y = np.meshgrid(x, y)
+        self.contour_timer.stop()
+        if not self.matrix:
+            self._clear_figure()
+            self.canvas.draw()
+            return
+
+        # Coarser pyramid level for big slices, coordinates are
+        # still expressed in the full-resolution indices. The 3D surface
+        # uses the full resolution, the polygon budget reduction (nanmax)
+        # keeps the peaks that the averaged levels would lose.
+        self.level = 0 if self.is_3d else self.display_level()
+        data, origin = self.display_data(self.level)
+        scale = 2 ** self.level
+
+        if not self.is_3d and self.options.get("fast_rendering", True):
+            self._plot_image(data, origin, scale)
+            return
+
+        self._clear_figure()
+        X, Y = self._grid(data, origin, scale)
+        if self.is_3d:
+            self._plot_3d(X, Y, data)
+        else:
+            self._plot_2d(X, Y, data)
+        self.canvas.draw()
 
-            if self.is_3d:
-                self._plot_3d(X, Y, self.slice.data)
-            else:
-                self._plot_2d(X, Y, self.slice.data)
+    @staticmethod
+    def _grid(data, origin, scale):
+        """Full-resolution coordinates of the data elements."""
+        x = origin[1] + (np.arange(data.shape[1]) + 0.5) * scale - 0.5
+        y = origin[0] + (np.arange(data.shape[0]) + 0.5) * scale - 0.5
+        return np.meshgrid(x, y)
+
+    def _clear_figure(self):
+        self.figure.clear()
+        self.surface = None
+        self._rotating = False
+        self.image = None
+        self._image_key = None
+        self._contour_data = None
+        self.contour_set = None
+        self.contour_labels = []
+
+    def _plot_image(self, data, origin, scale):
+        """Fast 2D rendering using a persistent image.
+
+        If only the slice changes, the data of the image are replaced
+        and only the axes are redrawn (blitting). Contours are removed
+        and drawn again when no change came for a while.
+        """
+        self._remove_contours()
+        key = (self.plane, self.level, self.view_region, data.shape)
+        extent = (origin[0] - 0.5, origin[0] + data.shape[0] * scale - 0.5,
+                  origin[1] + data.shape[1] * scale - 0.5, origin[1] - 0.5)
+        if np.any(np.isfinite(data)):
+            clim = (np.nanmin(data), np.nanmax(data))
+        else:
+            clim = (0.0, 1.0)
+
+        if self.image is not None and key == self._image_key:
+            self.image.set_data(data.T)
+            self.image.set_clim(*clim)
+            self.axes.draw_artist(self.image)
+            self.canvas.blit(self.axes.bbox)
+        else:
+            self._clear_figure()
+            self.axes = self.figure.add_subplot(111)
+            cmap = copy.copy(matplotlib.cm.coolwarm)
+            cmap.set_bad((1.0, 1.0, 0.0))
+            self.image = self.axes.imshow(data.T, extent=extent,
+                                          origin="upper", aspect="auto",
+                                          interpolation="nearest", cmap=cmap)
+            self.image.set_clim(*clim)
+            self.axes.set_xlabel(self.slice.plane_name[0])
+            self.axes.set_ylabel(self.slice.plane_name[1])
+            if self.view_region:
+                self.axes.set_xlim(self.view_region[0])
+                self.axes.set_ylim(tuple(reversed(self.view_region[1])))
+            self._image_key = key
+            self.canvas.draw()
+
+        self._contour_data = (data, origin, scale)
+        self.contour_timer.start()
+
+    def _remove_contours(self):
+        if self.contour_set is not None:
+            for collection in self.contour_set.collections:
+                collection.remove()
+            for text in self.contour_labels:
+                text.remove()
+        self.contour_set = None
+        self.contour_labels = []
+
+    def draw_contours(self):
+        """Draw contours over the image (fast rendering only)."""
+        if self.image is None or self._contour_data is None:
+            return
+        data, origin, scale = self._contour_data
+        if not np.any(np.isfinite(data)):
+            return
+        X, Y = self._grid(data, origin, scale)
+        xlim, ylim = self.axes.get_xlim(), self.axes.get_ylim()
+        contours = self.options.get("contours", 5)
+        self.contour_set = self.axes.contour(Y, X, data, contours, colors="k")
+        if self.options.get("contour_labels"):
+            self.contour_labels = self.axes.clabel(self.contour_set,
+                                                   fontsize=9, inline=1)
+        self.axes.set_xlim(xlim)
+        self.axes.set_ylim(ylim)
         self.canvas.draw()
 
 class ChartOptionsDialog(QtGui.QDialog):
     def __init__(self, parent):
         def onSaveClicked():
-            parent.options["contours"] = [float(s) for s in contours_text.text().split(" ")]
+            text = str(contours_text.text()).strip()
+            if text:
+                parent.options["contours"] = [float(s) for s in text.split()]
+            else:
+                parent.options.pop("contours", None)
+            parent.options["fast_rendering"] = fast_check_box.isChecked()
+            parent.options["3d_polygon_budget"] = budget_spin_box.value()
+            parent.options["3d_reduction"] = str(
+                reduction_combo.currentText())
             # print parent.options
             parent.update_chart()
             self.close()
@@ -127,6 +345,29 @@ class ChartOptionsDialog(QtGui.QDialog):
         layout.addWidget(QtGui.QLabel("Contours (space-separated)"))
         layout.addWidget(contours_text)
 
+        # Rendering
+        fast_check_box = QtGui.QCheckBox("Fast rendering (image, contours"
+                                         " drawn after changes stop)")
+        fast_check_box.setChecked(parent.options.get("fast_rendering", True))
+        layout.addWidget(fast_check_box)
+
+        # 3D level of detail
+        budget_spin_box = QtGui.QSpinBox()
+        budget_spin_box.setRange(100, 1000000)
+        budget_spin_box.setSingleStep(1000)
+        budget_spin_box.setValue(
+            parent.options.get("3d_polygon_budget", 20000))
+        layout.addWidget(QtGui.QLabel("3D polygon budget"))
+        layout.addWidget(budget_spin_box)
+
+        reduction_combo = QtGui.QComboBox()
+        for reduction in ("nanmax", "nanmean", "nanmin"):
+            reduction_combo.addItem(reduction)
+        reduction_combo.setCurrentIndex(reduction_combo.findText(
+            parent.options.get("3d_reduction", "nanmax")))
+        layout.addWidget(QtGui.QLabel("3D reduction of large slices"))
+        layout.addWidget(reduction_combo)
+
         button = QtGui.QPushButton("Save")
         button.clicked.connect(onSaveClicked)
         layout.addWidget(button)
@@ -0,0 +1,280 @@
+#
+# scoring_browser --- Simple Qt application for browsing
+# scoring outputs in Geant4
+#
+# Copyright (C) 2012-2014 Jan Pipek
+# (jan.pipek@gmail.com)
+#
+# This file may be distributed without limitation.
+#
+"""Batch processing of scoring outputs without the GUI.
+
+Usage:
+    python -m scoring_browser <command> [options] <files>...
+
+Commands (see --help of each):
+
+* convert - write files in another format (npy, h5, txt)
+
+* merge - sum (or weighted average of) many files into one
+
+* reduce - aggregate values over boxes of voxels
+
+* slice - write one 2D slice as a CSV table
+
+* stats - print statistics of each file (one JSON line per file)
+
+* export - write 2D tables of all slices as CSV or HTML
+
+Files are processed in parallel (-j) and a line is printed as soon as
+each of them is done. Input files are text outputs of Geant4 scoring,
+.npy files or HDF5 datasets (file.h5:path).
+"""
+import os
+import sys
+import json
+import argparse
+import multiprocessing
+
+import numpy
+
+from data_matrix import DataMatrixLoader, DataMatrixSlice2D
+from running_stats import RunningStatistics
+from heatmap import HeatmapColors
+from cache import SidecarCache
+from export import (write_matrix, write_csv_table, write_html_table,
+                    MATRIX_FORMATS)
+
+
+def output_name(args, file_name, suffix, extension):
+    """Name of an output file derived from an input file.
+
+    It is placed in args.output_dir (or next to the input).
+    """
+    base_name = file_name.partition(":")[0]
+    if base_name.lower().endswith((".h5", ".hdf5")):
+        file_name = base_name
+    directory = args.output_dir or os.path.dirname(file_name)
+    base = os.path.splitext(os.path.basename(file_name))[0]
+    name = os.path.join(directory, base + suffix + extension)
+    if os.path.abspath(name) == os.path.abspath(file_name):
+        raise Exception("Output would overwrite the input.")
+    return name
+
+
+def convert_file(args, matrix, file_name):
+    out = output_name(args, file_name, "", "." + args.to)
+    write_matrix(matrix, out)
+    return out
+
+
+def reduce_file(args, matrix, file_name):
+    reduced = matrix.reduced(args.factors, args.method, args.edges)
+    out = output_name(args, file_name, "_reduced", "." + args.to)
+    write_matrix(reduced, out)
+    return out
+
+
+def slice_file(args, matrix, file_name):
+    data = DataMatrixSlice2D(matrix, args.plane, args.index).data
+    if args.relative:
+        data = data / matrix.max_value
+    out = output_name(args, file_name, "_%s%d" % (args.plane, args.index),
+                      ".csv")
+    write_csv_table(out, data)
+    return out
+
+
+def stats_file(args, matrix, file_name):
+    stats = RunningStatistics()
+    for x0, block in matrix.iter_blocks():
+        stats.add(block)
+    return json.dumps({
+        "file": file_name,
+        "shape": list(matrix.shape),
+        "count": stats.count,
+        "nan_count": stats.nan_count,
+        "total": stats.total,
+        "mean": stats.mean,
+        "stddev": stats.stddev,
+        "minimum": stats.minimum,
+        "maximum": stats.maximum
+    }, sort_keys=True)
+
+
+def export_file(args, matrix, file_name):
+    axis = DataMatrixSlice2D.get_axis(args.plane)
+    indices = args.indices or range(matrix.shape[axis])
+    heatmap = HeatmapColors()
+    for index in indices:
+        data = DataMatrixSlice2D(matrix, axis, index).data
+        out = output_name(args, file_name, "_%s%03d" % (args.plane, index),
+                          "." + args.format)
+        if args.format == "html":
+            relative = data / matrix.max_value
+            write_html_table(out, relative if args.relative else data,
+                             heatmap.indices(relative), heatmap, args.plane)
+        else:
+            write_csv_table(out, data / matrix.max_value if args.relative
+                            else data)
+    return output_name(args, file_name, "_%s*" % args.plane,
+                       "." + args.format)
+
+
+# Commands processing the files one by one
+FILE_COMMANDS = {
+    "convert": convert_file,
+    "reduce": reduce_file,
+    "slice": slice_file,
+    "stats": stats_file,
+    "export": export_file
+}
+
+
+def process_file(task):
+    """Run a command for one file (in a worker process).
+
+    :param task: (args, file name)
+    :returns: (file name, result line, error message)
+    """
+    args, file_name = task
+    try:
+        matrix = DataMatrixLoader.load(file_name)
+        try:
+            return file_name, FILE_COMMANDS[args.command](
+                args, matrix, file_name), None
+        finally:
+            matrix.close()
+    except Exception as exc:
+        return file_name, None, str(exc) or exc.__class__.__name__
+
+
+def run_files(args):
+    """Process all files and print results as they come.
+
+    :returns: number of failed files
+    """
+    tasks = [(args, file_name) for file_name in args.inputs]
+    if args.jobs == 1 or len(tasks) == 1:
+        pool = None
+        results = (process_file(task) for task in tasks)
+    else:
+        pool = multiprocessing.Pool(args.jobs)
+        results = pool.imap_unordered(process_file, tasks)
+    failed = 0
+    try:
+        for file_name, result, error in results:
+            if error is None:
+                if args.command == "stats":
+                    sys.stdout.write(result + "\n")
+                else:
+                    sys.stdout.write("%s -> %s\n" % (file_name, result))
+                sys.stdout.flush()
+            else:
+                failed += 1
+                sys.stderr.write("%s: %s\n" % (file_name, error))
+    finally:
+        if pool:
+            pool.terminate()
+    return failed
+
+
+def run_merge(args):
+    def progress(done, total):
+        sys.stderr.write("\rmerged %d/%d" % (done, total))
+        if done == total:
+            sys.stderr.write("\n")
+
+    try:
+        matrix = DataMatrixLoader.merge(args.inputs, args.weights,
+                                        args.primaries, args.jobs,
+                                        not args.no_header_check,
+                                        None if args.quiet else progress)
+        write_matrix(matrix, args.output)
+    except Exception as exc:
+        sys.stderr.write("%s\n" % exc)
+        return 1
+    sys.stdout.write("%s\n" % args.output)
+    return 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog="scoring_browser",
+        description="Batch processing of Geant4 scoring outputs.")
+    subparsers = parser.add_subparsers(dest="command")
+
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("inputs", nargs="+", metavar="FILE")
+    common.add_argument("-j", "--jobs", type=int, default=None,
+                        help="number of processes (default: CPU count)")
+    common.add_argument("--cache", action="store_true",
+                        help="use (and fill) the cache of parsed text files")
+    common.add_argument("--dtype", default="float64",
+                        choices=("float64", "float32", "float16"),
+                        help="type of the loaded values (sums are "
+                             "accumulated in float64 anyway)")
+    writing = argparse.ArgumentParser(add_help=False)
+    writing.add_argument("-o", "--output-dir", default=None,
+                         help="directory of the outputs (default: next "
+                              "to the inputs)")
+    formats = sorted(set(extension[1:] for extension in MATRIX_FORMATS))
+    plane = argparse.ArgumentParser(add_help=False)
+    plane.add_argument("--plane", default="xy", choices=("xy", "yz", "xz"))
+    plane.add_argument("--relative", action="store_true",
+                       help="values relative to the maximum")
+
+    sub = subparsers.add_parser("convert", parents=[common, writing],
+                                help="write files in another format")
+    sub.add_argument("--to", default="npy", choices=formats)
+
+    sub = subparsers.add_parser("merge", parents=[common],
+                                help="sum many files into one")
+    sub.add_argument("-o", "--output", required=True,
+                     help="output file (.npy, .h5, .txt)")
+    weighting = sub.add_mutually_exclusive_group()
+    weighting.add_argument("--weights", type=float, nargs="+")
+    weighting.add_argument("--primaries", type=float, nargs="+",
+                           help="average weighted by numbers of primaries")
+    sub.add_argument("--no-header-check", action="store_true")
+    sub.add_argument("-q", "--quiet", action="store_true")
+
+    sub = subparsers.add_parser("reduce", parents=[common, writing],
+                                help="aggregate values over boxes")
+    sub.add_argument("--factors", type=int, nargs=3, required=True,
+                     metavar=("X", "Y", "Z"))
+    sub.add_argument("--method", default="sum")
+    sub.add_argument("--edges", default="strict",
+                     choices=("strict", "pad", "truncate"))
+    sub.add_argument("--to", default="npy", choices=formats)
+
+    sub = subparsers.add_parser("slice", parents=[common, writing, plane],
+                                help="write a 2D slice as CSV")
+    sub.add_argument("--index", type=int, required=True)
+
+    subparsers.add_parser("stats", parents=[common],
+                          help="print statistics (JSON lines)")
+
+    sub = subparsers.add_parser("export", parents=[common, writing, plane],
+                                help="write tables of slices")
+    sub.add_argument("--format", default="csv", choices=("csv", "html"))
+    sub.add_argument("--indices", type=int, nargs="+",
+                     help="slices to export (default: all)")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.cache:
+        DataMatrixLoader.cache = SidecarCache()
+    DataMatrixLoader.dtype = numpy.dtype(args.dtype)
+    output_dir = getattr(args, "output_dir", None)
+    if output_dir and not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    if args.command == "merge":
+        return run_merge(args)
+    return 1 if run_files(args) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -7,7 +7,8 @@
 #
 # This file may be distributed without limitation.
 #
-import re
+import os
+import numbers
 import numpy
 try:
     import h5py
@@ -25,12 +26,15 @@ class DataMatrix(object):
 
     The indexing is (mostly) forwarded to the inner numpy array.
 
-    * DataMatrix.relative provides a copy of the matrix scaled
-    relative to the maximum value (it is stored in the matrix
-    after first requested).
+    * Values relative to the maximum are computed on demand for
+    the requested part only (matrix[x, y, z, True]), no scaled copy
+    of the matrix is kept.
 
-    * DataMatrix.reduced() returns a copy of the matrix with values summed
-    over volumes of defined size (if division is possible).
+    * DataMatrix.version changes with each change of the values,
+    max_value and the derived data are cached for one version.
+
+    * DataMatrix.reduced() returns a copy of the matrix with values
+    aggregated (summed by default) over volumes of defined size.
     """
     def __init__(self, source=None, header=None):
         self.header = ""
@@ -50,17 +54,40 @@ class DataMatrix(object):
     def empty(self):
         return not(self.data_array)
 
+    def add(self, other, dtype=None):
+        """ Add two data matrices (in float64).
+
+        :param dtype: type of the result (default: that of the operands)
+        """
+        return self._arithmetic(numpy.add, other.data_array, dtype)
+
+    def subtract(self, other, dtype=None):
+        """ Subtract two data matrices (in float64).
+
+        :param dtype: type of the result (default: that of the operands)
+        """
+        return self._arithmetic(numpy.subtract, other.data_array, dtype)
+
+    def multiply(self, coefficient, dtype=None):
+        """ Multiply DataMatrix by a coefficient (in float64).
+
+        :param dtype: type of the result (default: that of the matrix)
+        """
+        return self._arithmetic(numpy.multiply, coefficient, dtype)
+
+    def _arithmetic(self, operation, operand, dtype):
+        dtype = dtype or numpy.result_type(self.data_array, operand)
+        result = operation(self.data_array, operand, dtype=numpy.float64)
+        return DataMatrix(result.astype(dtype, copy=False), self.header)
+
     def __add__(self, other):
-        """ Add two data matrices. """
-        return DataMatrix(self.data_array + other.data_array)
+        return self.add(other)
 
     def __sub__(self, other):
-        """ Subtract two data matrices. """
-        return DataMatrix(self.data_array - other.data_array)
+        return self.subtract(other)
 
     def __mul__(self, coefficient):
-        """ Multiply DataMatrix by a coefficient. """
-        return DataMatrix(self.data_array * coefficient)
+        return self.multiply(coefficient)
 
     def __getitem__(self, index):
         """ Array indexing.
@@ -70,14 +97,191 @@ class DataMatrix(object):
         """
         if not hasattr(index, "__len__"):
             return self.data_array[index]
+        data = self.data_array.__getitem__(index[0:3])
         if len(index) == 4 and index[3]:
-            m = self.relative
-        else:
-            m = self
-        return m.data_array.__getitem__(index[0:3])
+            data = data / self.max_value
+        return data
 
     def __setitem__(self, index, value):
         self.data_array.__setitem__(index, value)
+        self.invalidate()
+
+    @property
+    def version(self):
+        """Number increased with each change of the values."""
+        return getattr(self, "_version", 0)
+
+    def invalidate(self):
+        """Drop data derived from the matrix values.
+
+        Has to be called after the data are changed in place
+        (it increases version, which makes all cached values stale).
+        """
+        self._version = self.version + 1
+        if hasattr(self, "_pyramid"):
+            del self._pyramid
+
+    def _cached(self, name, compute):
+        """Value of compute() cached for the current version."""
+        cached = getattr(self, name, None)
+        if cached is None or cached[0] != self.version:
+            cached = (self.version, compute())
+            setattr(self, name, cached)
+        return cached[1]
+
+    def _cached_value(self, name):
+        """Value cached by _cached if it is still valid (or None)."""
+        cached = getattr(self, name, None)
+        if cached is None or cached[0] != self.version:
+            return None
+        return cached[1]
+
+    def _writable_array(self):
+        """The data array, copied first if it is read-only.
+
+        Arrays received over the network or memory-mapped from the cache
+        cannot be changed in place.
+        """
+        if not self.data_array.flags.writeable:
+            self.data_array = self.data_array.copy()
+        return self.data_array
+
+    def _apply(self, target, values, accumulate, region):
+        """Change values at target (an index) and update the caches.
+
+        The maximum is updated from the changed values only (if it is
+        still known), pyramid levels are updated in the region only.
+        """
+        array = self._writable_array()
+        max_value = self._cached_value("_maxValue")
+        if max_value is not None:
+            before = _abs_max(array[target])
+        if accumulate and isinstance(target[0], slice):
+            array[target] += values
+        elif accumulate:
+            # Increments of repeated indices are all added
+            numpy.add.at(array, target, values)
+        else:
+            array[target] = values
+        if max_value is not None:
+            after = _abs_max(array[target])
+            if before >= max_value and after < max_value:
+                # The maximum was changed here, it can be elsewhere now
+                max_value = None
+            else:
+                max_value = max(max_value, after)
+
+        pyramid = getattr(self, "_pyramid", None)
+        self.invalidate()
+        if max_value is not None:
+            self._maxValue = (self.version, max_value)
+        if pyramid:
+            volume = numpy.prod([high - low for low, high in region])
+            if volume * 8 < self.size:
+                self._pyramid = pyramid
+                self._update_pyramid(region)
+        return region
+
+    def _update_pyramid(self, region):
+        """Recompute pyramid levels in the region (full-resolution indices)."""
+        for n in sorted(self._pyramid):
+            m, base = self._level_base(n)
+            f = 2 ** (n - m)
+            # The region in the base, extended to whole boxes
+            base_region = tuple(
+                (low // 2 ** m // f * f, min(-(-high // 2 ** m // f) * f, size))
+                for (low, high), size in zip(region, base.shape))
+            source = base.data_array[tuple(slice(low, high)
+                                           for low, high in base_region)]
+            level = self._pyramid[n]
+            level.data_array[tuple(slice(low // f, -(-high // f))
+                                   for low, high in base_region)] = \
+                reduce_array(source, (f, f, f), "nanmean", "pad")
+            level.invalidate()
+
+    def apply_block(self, offset, block, accumulate=False):
+        """Replace (or add to) values in a rectangular block.
+
+        :param offset: (x, y, z) index of the first element of the block
+        :param block: 3D array of the new values (or increments)
+        :param accumulate: add the values instead of replacing
+        :returns: the changed region ((x0, x1), (y0, y1), (z0, z1))
+        """
+        block = numpy.asarray(block)
+        if block.ndim != 3 or len(offset) != 3:
+            raise ValueError("Block has to be 3D.")
+        region = tuple((int(low), int(low) + size)
+                       for low, size in zip(offset, block.shape))
+        if any(low < 0 or high > size
+               for (low, high), size in zip(region, self.shape)):
+            raise ValueError("Block out of the matrix.")
+        target = tuple(slice(low, high) for low, high in region)
+        return self._apply(target, block, accumulate, region)
+
+    # Relative room added along x when the matrix grows (see grow)
+    GROWTH_FACTOR = 1.5
+
+    def grow(self, shape):
+        """Enlarge the matrix to (at least) the shape.
+
+        New voxels are NaN (e.g. not written to the file yet). The array
+        is reallocated with room along the x axis (the slowest index
+        in the files), so that following a file being written plane
+        by plane copies the data only a few times.
+
+        :returns: whether the shape changed
+        """
+        old_shape = self.shape
+        new_shape = tuple(max(old, int(new))
+                          for old, new in zip(old_shape, shape))
+        if new_shape == old_shape:
+            return False
+        buffer = getattr(self, "_buffer", None)
+        if (buffer is None or self.data_array.base is not buffer or
+                buffer.shape[1:] != new_shape[1:] or
+                len(buffer) < new_shape[0]):
+            capacity = new_shape[0]
+            if new_shape[1:] == old_shape[1:]:
+                capacity = max(capacity,
+                               int(old_shape[0] * self.GROWTH_FACTOR))
+            buffer = numpy.empty((capacity,) + new_shape[1:],
+                                 dtype=self.dtype)
+            buffer.fill(numpy.nan)
+            buffer[:old_shape[0], :old_shape[1], :old_shape[2]] = (
+                self.data_array)
+            self._buffer = buffer
+        self.data_array = buffer[:new_shape[0]]
+        self.invalidate()
+        return True
+
+    def apply_sparse(self, indices, values, accumulate=False):
+        """Replace (or add to) values of individual voxels.
+
+        :param indices: (n, 3) array of voxel indices
+        :param values: n new values (or increments); when accumulating,
+            increments of a repeated voxel are all added
+        :returns: the changed region (bounding box of the voxels)
+        """
+        indices = numpy.asarray(indices, dtype=int).reshape(-1, 3)
+        values = numpy.asarray(values).reshape(-1)
+        if len(indices) != len(values):
+            raise ValueError("Different number of indices and values.")
+        if not len(indices):
+            return tuple((0, 0) for size in self.shape)
+        if (indices.min() < 0 or
+                numpy.any(indices.max(axis=0) >= self.shape)):
+            raise ValueError("Index out of the matrix.")
+        region = tuple(zip(indices.min(axis=0).tolist(),
+                           (indices.max(axis=0) + 1).tolist()))
+        return self._apply(tuple(indices.T), values, accumulate, region)
+
+    @property
+    def derived(self):
+        """Dictionary for caching results computed from the data.
+
+        It is emptied with each change of the values (see version).
+        """
+        return self._cached("_derived", dict)
 
     def __repr__(self):
         s = "DataMatrix(%d, %d, %d" % self.shape
@@ -90,7 +294,7 @@ class DataMatrix(object):
         return self.data_array[x, y, z]
 
     def relative_value_at(self, x, y, z):
-        return self.relative.value_at(x, y, z)
+        return self.value_at(x, y, z) / self.max_value
 
     @property
     def size(self):
@@ -100,35 +304,198 @@ class DataMatrix(object):
     def shape(self):
         return self.data_array.shape
 
+    @property
+    def dtype(self):
+        return self.data_array.dtype
+
+    @property
+    def nbytes(self):
+        """Memory used by the data."""
+        return self.data_array.nbytes
+
+    @property
+    def memory_usage(self):
+        """Memory used by the data and the cached derived matrices."""
+        return self.nbytes + self.pyramid_nbytes
+
+    def _result_dtype(self, dtype=None, method=None):
+        """Type of derived values (floating point even for integers).
+
+        Sums are at least float32 (they would overflow float16).
+        """
+        if dtype is not None:
+            return numpy.dtype(dtype)
+        if method in ("sum", "nansum"):
+            return numpy.promote_types(self.dtype, numpy.float32)
+        return numpy.promote_types(self.dtype, numpy.float16)
+
+    def astype(self, dtype):
+        """Copy of the matrix with values of another type."""
+        return DataMatrix(self.data_array.astype(dtype), header=self.header)
+
     @property
     def size_x(self):
-        return self.data_array.shape[0]
+        return self.shape[0]
 
     @property
     def size_y(self):
-        return self.data_array.shape[1]
+        return self.shape[1]
 
     @property
     def size_z(self):
-        return self.data_array.shape[2]
+        return self.shape[2]
+
+    def iter_blocks(self, multiple=1):
+        """Iterate over the data in blocks along the x axis.
+
+        :param multiple: length of all blocks (except the last one)
+            is a multiple of this number
+        :returns: generator of (x0, block) pairs, block being a numpy array
+        with data for x0 <= x < x0 + len(block).
+        """
+        yield 0, self.data_array
 
     @property
     def max_value(self):
-        if not hasattr(self, "_maxValue"):
-            max_ = numpy.nanmax(self.data_array)
-            min_ = numpy.nanmin(self.data_array)
-            self._maxValue = max(numpy.abs(min_), numpy.abs(max_))
-        return self._maxValue
+        return self.compute_max_value()
+
+    def compute_max_value(self, progress=None):
+        """Maximum absolute value (max_value), computed block by block.
+
+        :param progress: callable accepting (planes done, planes), called
+            after each block; it can stop the computation by raising
+            (e.g. LoadCancelled)
+        """
+        max_value = self._cached_value("_maxValue")
+        if max_value is not None:
+            return max_value
+        maxima = []
+        for x0, block in self.iter_blocks():
+            maxima.append(numpy.nanmax(numpy.abs(block)))
+            if progress:
+                progress(x0 + len(block), self.size_x)
+        return self._cached("_maxValue", lambda: numpy.nanmax(maxima))
+
+    def value_range(self, positive=False):
+        """Minimum and maximum of all values (NaN's are ignored).
+
+        :param positive: consider only positive values
+        """
+        limits = []
+        for x0, block in self.iter_blocks():
+            if positive:
+                block = block[block > 0]
+            if numpy.any(~numpy.isnan(block)):
+                limits.append((numpy.nanmin(block), numpy.nanmax(block)))
+        if not limits:
+            return numpy.nan, numpy.nan
+        limits = numpy.array(limits)
+        return limits[:, 0].min(), limits[:, 1].max()
+
+    def histogram(self, bins=100):
+        """Histogram of all values (computed block by block).
+
+        :param bins: number of bins spanning the value range
+            or an array of bin edges
+        :returns: (counts, edges) as in numpy.histogram
+        """
+        if numpy.ndim(bins) == 0:
+            min_, max_ = self.value_range()
+            edges = numpy.histogram([], bins, (min_, max_))[1]
+        else:
+            edges = numpy.asarray(bins, dtype=float)
+        counts = numpy.zeros(len(edges) - 1, dtype=int)
+        for x0, block in self.iter_blocks():
+            block = block[~numpy.isnan(block)]
+            counts += numpy.histogram(block, edges)[0]
+        return counts, edges
+
+    # Maximum number of elements binned at once by slice_histograms
+    HISTOGRAM_CHUNK = 1 << 22
+
+    def slice_histograms(self, axis, edges):
+        """Histograms of all slices perpendicular to an axis at once.
+
+        Bins of all values are found in one pass and counted together
+        with the slice index.
+
+        :param edges: bin edges (as in numpy.histogram)
+        :returns: array of counts with shape (number of slices, bins)
+        """
+        edges = numpy.asarray(edges, dtype=float)
+        bins = len(edges) - 1
+        slices = self.shape[axis]
+        counts = numpy.zeros(slices * bins, dtype=int)
+        plane_size = max(1, self.size // self.size_x)
+        step = max(1, self.HISTOGRAM_CHUNK // plane_size)
+        for x0, block in self.iter_blocks():
+            for i in range(0, block.shape[0], step):
+                chunk = block[i:i + step]
+                index_shape = [1, 1, 1]
+                index_shape[axis] = chunk.shape[axis]
+                slice_index = numpy.arange(chunk.shape[axis])
+                if axis == 0:
+                    slice_index += x0 + i
+                slice_index = slice_index.reshape(index_shape)
+
+                bin_index = numpy.searchsorted(edges, chunk, side="right") - 1
+                bin_index[chunk == edges[-1]] = bins - 1   # Last bin closed
+                valid = (bin_index >= 0) & (bin_index < bins)
+                combined = slice_index * bins + bin_index
+                counts += numpy.bincount(combined[valid],
+                                         minlength=slices * bins)
+        return counts.reshape(slices, bins)
+
+    def close(self):
+        """Release resources held by the matrix (if any)."""
+        pass
 
     @property
     def relative(self):
         """ Matrix with all values relative.
 
-        Values normalized to the largest element."""
-        if not hasattr(self, "_relative"):
-            self._relative = DataMatrix(self.data_array / self.max_value,
-                                        header=self.header)
-        return self._relative
+        Values normalized to the largest element. It is a new copy
+        (prefer matrix[x, y, z, True] for parts of the matrix)."""
+        return DataMatrix(self.data_array / self.max_value,
+                          header=self.header)
+
+    def level(self, n):
+        """Matrix reduced 2^n times in each dimension (for display).
+
+        The levels form a pyramid built lazily by averaging boxes
+        (NaN's are ignored, incomplete boxes at the edges are averaged
+        as well). Each level is reduced directly from the finest level
+        already built (or the matrix itself, block by block), so only
+        the requested levels are kept in memory. The levels are cached
+        until invalidate() is called.
+        """
+        if n == 0:
+            return self
+        if not hasattr(self, "_pyramid"):
+            self._pyramid = {}
+        if n not in self._pyramid:
+            m, base = self._level_base(n)
+            f = 2 ** (n - m)
+            self._pyramid[n] = base.reduced((f, f, f), "nanmean", "pad")
+        return self._pyramid[n]
+
+    def _level_base(self, n):
+        """(m, level m) from which level n is reduced (m < n)."""
+        built = [m for m in getattr(self, "_pyramid", {}) if m < n]
+        if built:
+            return max(built), self._pyramid[max(built)]
+        return 0, self
+
+    @property
+    def level_count(self):
+        """Number of pyramid levels (including the matrix itself)."""
+        return int(numpy.ceil(numpy.log2(max(self.shape)))) + 1
+
+    @property
+    def pyramid_nbytes(self):
+        """Memory used by the already built pyramid levels."""
+        return sum(level.nbytes
+                   for level in getattr(self, "_pyramid", {}).values())
 
     def allowed_reductions(self):
         """ Tuple of possible reductions in all dimensions.
@@ -140,80 +507,1038 @@ class DataMatrix(object):
             (i for i in range(1, self.size_z + 1) if self.size_z % i == 0)
         )
 
-    def reduced(self, indices=(1, 1, 1)):
+    def reduced(self, indices=(1, 1, 1), method="sum", edges="strict",
+                dtype=None):
         """ New matrix with reduced dimensions.
 
         Each x,y,z-element box is replaced with one element.
-        All data in the box are added.
+        All data in the box are aggregated (see reduce_array).
+
+        :param dtype: type of the result (default: the same as the data,
+            at least float32 for sums)
         """
-        allowed = self.allowed_reductions()
-        if not all([(indices[i] in allowed[i]) for i in range(0, 3)]):
-            raise ValueError("Wrong index")
-        new_array = numpy.ndarray(shape=(self.size_x / indices[0],
-                                         self.size_y / indices[1],
-                                         self.size_z / indices[2]),
-                                  dtype=float)
-        for x in range(0, new_array.shape[0]):
-            for y in range(0, new_array.shape[1]):
-                for z in range(0, new_array.shape[2]):
-                    x0 = x * indices[0]
-                    x1 = x0 + indices[0]
-                    y0 = y * indices[1]
-                    y1 = y0 + indices[1]
-                    z0 = z * indices[2]
-                    z1 = z0 + indices[2]
-                    new_array[x, y, z] = (
-                        self.data_array[x0:x1, y0:y1, z0:z1].sum())
+        indices = tuple(int(i) for i in indices)
+        shape = reduced_shape(self.shape, indices, edges)
+        new_array = numpy.empty(shape, dtype=self._result_dtype(dtype, method))
+        for x0, block in self.iter_blocks(indices[0]):
+            reduced_block = reduce_array(block, indices, method, edges)
+            x0 //= indices[0]
+            new_array[x0:x0 + reduced_block.shape[0]] = reduced_block
         return DataMatrix(new_array, header=self.header)
 
 
+def _abs_max(values):
+    """Maximum absolute value ignoring NaN's (-inf if there is none)."""
+    values = numpy.abs(values)
+    values = values[~numpy.isnan(values)]
+    return values.max() if values.size else -numpy.inf
+
+
+# Aggregation functions available for reduce_array
+REDUCTIONS = {
+    "sum": numpy.sum,
+    "mean": numpy.mean,
+    "max": numpy.max,
+    "min": numpy.min,
+    "nansum": numpy.nansum,
+    "nanmean": numpy.nanmean,
+    "nanmax": numpy.nanmax,
+    "nanmin": numpy.nanmin
+}
+
+# Reductions accumulated in float64 (whatever the type of the data)
+_ACCUMULATING = ("sum", "mean", "nansum", "nanmean")
+
+# Values used to fill incomplete boxes for edges="pad"
+# ("mean" is treated separately, the padded elements are not counted)
+_PAD_VALUES = {
+    "sum": 0.0,
+    "mean": 0.0,
+    "max": -numpy.inf,
+    "min": numpy.inf,
+    "nansum": numpy.nan,
+    "nanmean": numpy.nan,
+    "nanmax": numpy.nan,
+    "nanmin": numpy.nan
+}
+
+
+def reduced_shape(shape, factors, edges="strict"):
+    """Shape of an array after reduce_array."""
+    if len(factors) != len(shape) or min(factors) < 1:
+        raise ValueError("Wrong index")
+    if edges == "strict":
+        if any(size % factor for size, factor in zip(shape, factors)):
+            raise ValueError("Wrong index")
+        return tuple(size // factor for size, factor in zip(shape, factors))
+    elif edges == "truncate":
+        return tuple(size // factor for size, factor in zip(shape, factors))
+    elif edges == "pad":
+        return tuple(-(-size // factor) for size, factor in zip(shape, factors))
+    else:
+        raise ValueError("Unknown edge policy: " + str(edges))
+
+
+def reduce_array(array, factors, method="sum", edges="strict"):
+    """Aggregate values in boxes of given size (in one numpy pass).
+
+    The array is reshaped so that each box gets its own axes which
+    are then reduced at once.
+
+    :param factors: size of the box along each axis
+    :param method: name of the aggregation (see REDUCTIONS)
+    :param edges: what to do if a factor does not divide the size:
+        "strict" - raise ValueError
+        "truncate" - ignore the incomplete boxes at the end
+        "pad" - aggregate the incomplete boxes as well
+
+    Sums and means are accumulated in float64.
+    """
+    if method not in REDUCTIONS:
+        raise ValueError("Unknown reduction: " + str(method))
+    shape = reduced_shape(array.shape, factors, edges)
+
+    if edges == "truncate":
+        array = array[tuple(slice(0, size * factor)
+                            for size, factor in zip(shape, factors))]
+    elif edges == "pad":
+        padding = [(0, size * factor - old_size) for size, factor, old_size
+                   in zip(shape, factors, array.shape)]
+        if any(after for before, after in padding):
+            array = numpy.pad(array.astype(float), padding, "constant",
+                              constant_values=_PAD_VALUES[method])
+            if method == "mean":
+                # Divide sums by the real number of elements in each box
+                counts = numpy.ones(shape)
+                for axis, (size, factor) in enumerate(zip(shape, factors)):
+                    axis_counts = numpy.ones(size) * factor
+                    axis_counts[-1] -= padding[axis][1]
+                    counts_shape = [1] * len(shape)
+                    counts_shape[axis] = size
+                    counts = counts * axis_counts.reshape(counts_shape)
+                return reduce_array(array, factors, "sum") / counts
+
+    boxes_shape = []
+    for size, factor in zip(shape, factors):
+        boxes_shape += [size, factor]
+    boxes = array.reshape(boxes_shape)
+    axes = tuple(range(1, 2 * len(shape), 2))
+    if method in _ACCUMULATING:
+        return REDUCTIONS[method](boxes, axis=axes, dtype=numpy.float64)
+    return REDUCTIONS[method](boxes, axis=axes)
+
+
+class ScoringFileParser(object):
+    """Incremental parser of the text files written by Geant4 scoring.
+
+    Text is fed in blocks of arbitrary size (see feed), only complete
+    lines are parsed. The columns of all lines in a block are converted
+    to numpy arrays at once and the values are scattered into a
+    preallocated array which grows when an index outside of it appears.
+
+    * Comment lines (starting with a "#") before the first data line
+    are collected in the header.
+
+    * Only the first four columns (iX, iY, iZ, value) are used, the
+    additional ones (e.g. total(val^2), entry) are ignored.
+    """
+    def __init__(self, shape=None, dtype=float):
+        self.dtype = dtype
+        self.header_lines = []
+        self.count = 0
+        self.columns = None
+        self.data_array = None
+        self.line_number = 0    # Lines parsed so far
+        self._rest = ""
+        if shape:
+            self.reserve(shape)
+
+    @property
+    def header(self):
+        return "\n".join(self.header_lines)
+
+    def reserve(self, shape):
+        """Make sure that the data array has at least the given shape.
+
+        Newly allocated elements are set to NaN.
+        """
+        if self.data_array is None:
+            self.data_array = numpy.empty(shape, dtype=self.dtype)
+            self.data_array.fill(numpy.nan)
+            return
+        old_shape = self.data_array.shape
+        new_shape = tuple(max(old_shape[i], shape[i]) for i in range(3))
+        if new_shape != old_shape:
+            new_array = numpy.empty(new_shape, dtype=self.dtype)
+            new_array.fill(numpy.nan)
+            new_array[:old_shape[0], :old_shape[1], :old_shape[2]] = (
+                self.data_array)
+            self.data_array = new_array
+
+    def feed(self, text):
+        """Parse all complete lines in the text.
+
+        An unfinished last line is kept until the next call.
+        """
+        text = self._rest + text
+        end = text.rfind("\n")
+        if end < 0:
+            self._rest = text
+        else:
+            self._rest = text[end + 1:]
+            self._parse_lines(text[:end + 1])
+
+    def close(self):
+        """Parse the remaining (unterminated) line."""
+        rest, self._rest = self._rest, ""
+        if rest.strip():
+            self._parse_lines(rest)
+
+    def _parse_lines(self, text):
+        values = self.parse_rows(text)
+        if values is None:
+            return
+        indices = values[:, :3].astype(numpy.intp)
+        self.reserve(tuple(indices.max(axis=0) + 1))
+        self.data_array[indices[:, 0], indices[:, 1], indices[:, 2]] = (
+            values[:, 3])
+        self.count += values.shape[0]
+
+    def parse_rows(self, text):
+        """Columns of complete data lines (header lines are collected).
+
+        :returns: (n, columns) array or None if there are no data
+        """
+        first_line_number = self.line_number + 1
+        self.line_number += text.count("\n") + (not text.endswith("\n"))
+        if not self.count and not self.columns:
+            # Header at the start of the file
+            while text.startswith("#"):
+                line, _, text = text.partition("\n")
+                self.header_lines.append(line.rstrip())
+                first_line_number += 1
+        data_text = text
+        if data_text.startswith("#") or "\n#" in data_text:
+            # Comments between data lines (rare)
+            data_text = "".join(line for line in text.splitlines(True)
+                                if not line.startswith("#"))
+        if not data_text.strip():
+            return None
+        if self.columns is None:
+            first_line = data_text.lstrip().split("\n", 1)[0]
+            self.columns = len(first_line.split(","))
+            if self.columns < 4:
+                raise Exception("Invalid data line: " + first_line.strip())
+
+        # fromstring stops silently at the first invalid token
+        values = numpy.fromstring(data_text.replace(",", " "), sep=" ")
+        rows = data_text.count("\n") + (not data_text.endswith("\n"))
+        if values.size != rows * self.columns:
+            rows = sum(1 for line in data_text.splitlines() if line.strip())
+            if values.size != rows * self.columns:
+                self._raise_invalid_line(text, first_line_number)
+        values = values.reshape(-1, self.columns)
+        if not len(values):
+            return None
+        if values[:, :3].min() < 0:
+            self._raise_invalid_line(text, first_line_number)
+        return values
+
+    def _raise_invalid_line(self, text, first_line_number):
+        """Find the first invalid data line and report it."""
+        for number, line in enumerate(text.splitlines(), first_line_number):
+            if not line.strip() or line.startswith("#"):
+                continue
+            items = line.split(",")
+            try:
+                if (len(items) != self.columns or
+                        min(int(item) for item in items[:3]) < 0):
+                    raise ValueError()
+                [float(item) for item in items[3:]]
+            except ValueError:
+                raise Exception("Invalid data on line %d: %s"
+                                % (number, line.strip()))
+        raise Exception("Invalid data in file.")
+
+
+class LoadCancelled(Exception):
+    """Raised by a progress callback to stop loading."""
+    pass
+
+
+class ReloadNeeded(Exception):
+    """The file cannot be followed incrementally (see ScoringFileTail)."""
+    pass
+
+
+class ScoringFileTail(object):
+    """Applies lines appended to a scoring text file to its matrix.
+
+    Only the bytes after the last complete line seen are read and parsed
+    (see update). Voxels outside of the matrix make it grow (the file
+    is still being written, see DataMatrix.grow). If the file was
+    rewritten (it is shorter or its start or the last seen line changed)
+    or the matrix cannot be changed, ReloadNeeded is raised and the file
+    has to be loaded again.
+    """
+    # Bytes compared to detect rewriting
+    SIGNATURE_SIZE = 4096
+
+    def __init__(self, file_name, size=None):
+        """
+        :param size: number of bytes already loaded into the matrix
+            (default: the current file size)
+        """
+        self.file_name = file_name
+        with open(file_name, "rb") as f:
+            if size is None:
+                size = os.fstat(f.fileno()).st_size
+            start = max(0, size - DataMatrixLoader.BLOCK_SIZE)
+            f.seek(start)
+            data = f.read(size - start)
+            # An unterminated last line is parsed again when finished
+            self.offset = start + data.rfind("\n") + 1
+            f.seek(0)
+            self._head = f.read(min(self.SIGNATURE_SIZE, self.offset))
+        self._tail = self._read_tail()
+        self._parser = ScoringFileParser()
+
+    def _read_tail(self):
+        with open(self.file_name, "rb") as f:
+            f.seek(max(0, self.offset - self.SIGNATURE_SIZE))
+            return f.read(min(self.SIGNATURE_SIZE, self.offset))
+
+    def _check(self, f):
+        """Raise ReloadNeeded if the loaded part of the file changed."""
+        if os.fstat(f.fileno()).st_size < self.offset:
+            raise ReloadNeeded("File was truncated.")
+        if (f.read(len(self._head)) != self._head or
+                self._read_tail() != self._tail):
+            raise ReloadNeeded("File was rewritten.")
+
+    def update(self, matrix):
+        """Apply complete lines appended since the last update.
+
+        :returns: the changed region (see DataMatrix.apply_sparse)
+            or None if there are no new lines; check the shape
+            of the matrix, it could have grown
+        """
+        with open(self.file_name, "rb") as f:
+            self._check(f)
+            f.seek(self.offset)
+            data = f.read()
+        end = data.rfind("\n") + 1
+        if not end:
+            return None
+        values = self._parser.parse_rows(data[:end])
+        region = None
+        if values is not None:
+            indices = values[:, :3].astype(numpy.intp)
+            try:
+                matrix.grow(indices.max(axis=0) + 1)
+                region = matrix.apply_sparse(indices, values[:, 3])
+            except Exception as exc:
+                # Read-only matrices
+                raise ReloadNeeded(str(exc))
+        self.offset += end
+        self._tail = self._read_tail()
+        return region
+
+
 class DataMatrixLoader(object):
+    # Size of blocks in which text files are read
+    BLOCK_SIZE = 1 << 24
+
+    # SidecarCache for parsed text files (None => no caching)
+    cache = None
+
+    # Matrices with a larger fraction of zeros are stored as
+    # SparseDataMatrix (None => always dense)
+    sparse_threshold = 0.9
+
+    # Type of the loaded values (float32 or float16 save memory,
+    # Geant4 writes only about 6 significant digits)
+    dtype = numpy.float64
+
+    @staticmethod
+    def count_nonzero(array):
+        """Number of non-zero values (counted in blocks of planes)."""
+        return sum(numpy.count_nonzero(array[x0:x0 + 64])
+                   for x0 in range(0, len(array), 64))
+
+    @staticmethod
+    def matrix_from_array(array, header=None, dtype=None, nonzero=None):
+        """DataMatrix or SparseDataMatrix (see sparse_threshold).
+
+        :param dtype: type of the values (default: that of the array)
+        :param nonzero: number of non-zero values if known
+            (the array is not scanned then)
+        """
+        threshold = DataMatrixLoader.sparse_threshold
+        convert = dtype is not None and array.dtype != dtype
+        if threshold is not None and array.size:
+            if nonzero is None:
+                nonzero = DataMatrixLoader.count_nonzero(array)
+            if nonzero < (1.0 - threshold) * array.size:
+                matrix = SparseDataMatrix.from_array(array, header)
+                return matrix.astype(dtype) if convert else matrix
+        if convert:
+            array = array.astype(dtype)
+        return DataMatrix(source=array, header=header)
+
     @staticmethod
-    def from_csv(file_name):
-        with open(file_name) as f:
-            text = f.read()
-
-        points = []
-        linePattern = re.compile("(\d+),(\d+),(\d+),([0-9.e\-]*)")
-        commentLinePattern = re.compile("#.*")
-
-        for line in text.splitlines():
-            # Line with data
-            match = linePattern.match(line)
-            if match:
-                x = int(match.group(1))
-                y = int(match.group(2))
-                z = int(match.group(3))
-                val = float(match.group(4))
-                points.append([x, y, z, val])
-
-            # Line with comments (starting with a "#")
-            match = commentLinePattern.match(line)
-            if match:
+    def _guess_csv_shape(f):
+        """Shape of the matrix estimated from the last line of the file.
+
+        Geant4 writes the voxels in order, so the last line contains
+        the largest indices. If it does not, the parser will grow
+        the array as needed.
+        """
+        f.seek(0, 2)
+        size = f.tell()
+        f.seek(max(0, size - 4096))
+        lines = f.read().strip().splitlines()
+        f.seek(0)
+        if lines and not lines[-1].startswith("#"):
+            try:
+                return tuple(int(i) + 1 for i in lines[-1].split(",")[:3])
+            except ValueError:
                 pass
+        return None
 
-        sizeX = max(l[0] for l in points) + 1
-        sizeY = max(l[1] for l in points) + 1
-        sizeZ = max(l[2] for l in points) + 1
+    @staticmethod
+    def from_csv(file_name, dtype=None, progress=None, source=None,
+                 writable=False, partial=False):
+        """Matrix from a text file written by Geant4 scoring.
+
+        :param dtype: type of the values (default: DataMatrixLoader.dtype)
+        :param progress: callable accepting (bytes read, file size),
+            called after each block; it can raise LoadCancelled
+        :param source: list (or e.g. LineIndex) to which the blocks
+            of text are appended as they are read (the file is read once
+            for display as well); nothing is appended if the matrix
+            is taken from the cache
+        :param writable: always return a dense matrix which can be
+            updated in place (e.g. by ScoringFileTail)
+        :param partial: accept a file which is still being written,
+            the missing voxels are NaN (such files are not cached)
+        """
+        dtype = numpy.dtype(dtype or DataMatrixLoader.dtype)
+        cache = DataMatrixLoader.cache
+        if cache:
+            cached = cache.load(file_name)
+            if cached:
+                matrix = DataMatrixLoader._from_cache(cached, dtype)
+                if matrix is not None:
+                    if writable:
+                        copy = DataMatrixLoader.writable(matrix)
+                        if copy is not matrix:
+                            matrix.close()
+                        return copy
+                    return matrix
 
-        data_array = numpy.ndarray(shape=(sizeX, sizeY, sizeZ),
-                                        dtype=float)
-        if len(points) != data_array.size:
+        # Binary mode => the blocks match the bytes of the file
+        with open(file_name, "rb") as f:
+            parser = ScoringFileParser(DataMatrixLoader._guess_csv_shape(f),
+                                       dtype)
+            file_size = os.fstat(f.fileno()).st_size
+            done = 0
+            while True:
+                block = f.read(DataMatrixLoader.BLOCK_SIZE)
+                if not block:
+                    break
+                if source is not None:
+                    source.append(block)
+                parser.feed(block)
+                done += len(block)
+                if progress:
+                    progress(done, file_size)
+            try:
+                parser.close()
+            except Exception:
+                # The last line of a file being written can be unfinished
+                # (ScoringFileTail parses it again)
+                if not partial:
+                    raise
+
+        if parser.data_array is None or not (
+                parser.count == parser.data_array.size or
+                partial and parser.count < parser.data_array.size):
             raise Exception("Incomplete file.")
 
-        for p in points:
-            data_array[p[0], p[1], p[2]] = p[3]
+        if parser.count != parser.data_array.size:
+            cache = None    # The file will change
+        nonzero = None
+        if cache:
+            nonzero = DataMatrixLoader.count_nonzero(parser.data_array)
+        if writable:
+            matrix = DataMatrix(source=parser.data_array,
+                                header=parser.header)
+        else:
+            matrix = DataMatrixLoader.matrix_from_array(
+                parser.data_array, parser.header, nonzero=nonzero)
+        if cache:
+            DataMatrixLoader._store_in_cache(cache, file_name, matrix,
+                                             nonzero)
+        return matrix
 
-        return DataMatrix(source = data_array)      
+    @staticmethod
+    def writable(matrix):
+        """Dense matrix which can be updated in place.
+
+        Sparse and read-only (e.g. memory-mapped) matrices are copied,
+        others are returned as they are.
+        """
+        if (isinstance(matrix, SparseDataMatrix) or
+                not matrix.data_array.flags.writeable):
+            return DataMatrix(source=numpy.array(matrix.data_array),
+                              header=matrix.header)
+        return matrix
+
+    @staticmethod
+    def _store_in_cache(cache, file_name, matrix, nonzero):
+        """Put a parsed matrix into the cache.
+
+        Sparse matrices are stored as (index, value) records, so that
+        they are not expanded when read again. The format and the number
+        of non-zero values are kept in the metadata.
+        """
+        if isinstance(matrix, SparseDataMatrix):
+            records = numpy.empty(len(matrix.values),
+                                  dtype=[("index", numpy.int64),
+                                         ("value", matrix.dtype)])
+            records["index"] = matrix.indices
+            records["value"] = matrix.values
+            cache.store(file_name, records, matrix.header, format="sparse",
+                        shape=list(matrix.shape), nonzero=nonzero)
+        else:
+            cache.store(file_name, matrix.data_array, matrix.header,
+                        format="dense", nonzero=nonzero)
+
+    @staticmethod
+    def _from_cache(cached, dtype):
+        """Matrix from a cache entry (see _store_in_cache).
+
+        :returns: the matrix or None if the values were cached
+            with a lower precision (they are parsed again then)
+        """
+        data_array, meta = cached
+        header = meta["header"]
+        if meta.get("format") == "sparse":
+            if not numpy.can_cast(dtype, data_array.dtype["value"]):
+                return None
+            # Copies of the fields (the records are memory-mapped)
+            matrix = SparseDataMatrix(meta["shape"],
+                                      numpy.array(data_array["index"]),
+                                      numpy.array(data_array["value"]),
+                                      header)
+            threshold = DataMatrixLoader.sparse_threshold
+            if (threshold is None or
+                    len(matrix.values) >= (1.0 - threshold) * matrix.size):
+                return DataMatrixLoader.matrix_from_array(
+                    matrix.data_array, header, dtype, len(matrix.values))
+            return matrix.astype(dtype) if matrix.dtype != dtype else matrix
+        if not numpy.can_cast(dtype, data_array.dtype):
+            return None
+        # Entries without the count (older versions) are scanned
+        return DataMatrixLoader.matrix_from_array(data_array, header, dtype,
+                                                  meta.get("nonzero"))
+
+    @staticmethod
+    def from_npy(file_name, dtype=None):
+        """Matrix from a .npy file.
+
+        The array is memory-mapped (read-only) unless it is converted
+        to another dtype (default: DataMatrixLoader.dtype).
+        """
+        return DataMatrixLoader.matrix_from_array(
+            numpy.load(file_name, mmap_mode="r"), None,
+            dtype or DataMatrixLoader.dtype)
+
+    @staticmethod
+    def load(file_name, dtype=None):
+        """Matrix from a file of any supported format.
+
+        * file.h5:path (or .hdf5) - dataset in an HDF5 file
+
+        * file.npy - numpy array
+
+        * anything else - text output of Geant4 scoring
+
+        :param dtype: type of the values (HDF5 datasets keep their own)
+        """
+        base, _, path = file_name.partition(":")
+        if base.lower().endswith((".h5", ".hdf5")):
+            return DataMatrixLoader.from_hdf5(base, path or "data")
+        elif file_name.lower().endswith(".npy"):
+            return DataMatrixLoader.from_npy(file_name, dtype)
+        else:
+            return DataMatrixLoader.from_csv(file_name, dtype)
+
+    @staticmethod
+    def merge(file_names, weights=None, primaries=None, processes=None,
+              check_header=True, progress=None, dtype=None):
+        """Sum of matrices from several files (e.g. of split jobs).
+
+        Any format of load() is accepted. The files are parsed in a pool
+        of processes and added to one float64 accumulator as they come,
+        so only a few of them are in the memory at once. Sparse matrices
+        are passed from the pool as they are.
+
+        :param weights: coefficient of each file (default 1)
+        :param primaries: number of primaries of each file; the result
+            is then the average weighted by them (for files normalized
+            per primary)
+        :param processes: size of the pool (None = number of CPUs,
+            1 = parse in this process)
+        :param check_header: require the same header in all files
+        :param progress: callable accepting (files done, files total)
+        :param dtype: type of the result (default: DataMatrixLoader.dtype)
+        """
+        file_names = list(file_names)
+        if not file_names:
+            raise ValueError("No files to merge.")
+        if primaries is not None:
+            if weights is not None:
+                raise ValueError("Use either weights or primaries.")
+            primaries = [float(n) for n in primaries]
+            if len(primaries) != len(file_names):
+                raise ValueError("Number of primaries differs from number "
+                                 "of files.")
+            if not all(n > 0 and numpy.isfinite(n) for n in primaries):
+                raise ValueError("Numbers of primaries have to be positive.")
+            total = sum(primaries)
+            weights = [n / total for n in primaries]
+        if weights is not None and len(weights) != len(file_names):
+            raise ValueError("Number of weights differs from number of files.")
+        weights = weights or [1.0] * len(file_names)
+
+        if processes == 1 or len(file_names) == 1:
+            pool = None
+            results = (_parse_for_merge(item) for item in enumerate(file_names))
+        else:
+            import multiprocessing
+            pool = multiprocessing.Pool(processes)
+            results = pool.imap_unordered(_parse_for_merge,
+                                          enumerate(file_names))
+
+        accumulator = None
+        first_header = ""    # Files without header (e.g. .npy) are not checked
+        try:
+            for i, (index, data, header) in enumerate(results):
+                file_name = file_names[index]
+                if accumulator is None:
+                    accumulator = numpy.zeros(data.shape, dtype=numpy.float64)
+                    first_name = file_name
+                elif data.shape != accumulator.shape:
+                    raise Exception("Shape of %s differs from %s."
+                                    % (file_name, first_name))
+                if not first_header:
+                    first_header, header_name = header, file_name
+                elif check_header and header and header != first_header:
+                    raise Exception("Header of %s differs from %s."
+                                    % (file_name, header_name))
+                if isinstance(data, SparseDataMatrix):
+                    accumulator.reshape(-1)[data.indices] += (
+                        weights[index] *
+                        numpy.asarray(data.values, numpy.float64))
+                else:
+                    accumulator += (weights[index] *
+                                    numpy.asarray(data, numpy.float64))
+                if progress:
+                    progress(i + 1, len(file_names))
+        finally:
+            if pool:
+                pool.terminate()
+        return DataMatrixLoader.matrix_from_array(
+            accumulator, first_header, dtype or DataMatrixLoader.dtype)
 
     @staticmethod
     def from_hdf5(file_name, path):
         if not HDF5_ENABLED:
             raise Exception("HDF5 library not found => loading disabled.")
-        f = h5py.File(file_name)
-        print "loaded " + file_name
-        data = numpy.array(f.get(path))
-        return DataMatrix(source = data)
+        f = h5py.File(file_name, "r")
+        return H5DataMatrix(f[path], h5file=f)
+
+
+def _parse_for_merge(item):
+    """(index, data, header) of an (index, file name) (run in the pool).
+
+    Data are either a numpy array or a SparseDataMatrix.
+    """
+    index, file_name = item
+    matrix = DataMatrixLoader.load(file_name)
+    try:
+        if isinstance(matrix, SparseDataMatrix):
+            return index, matrix, matrix.header
+        return index, numpy.asarray(matrix.data_array), matrix.header
+    finally:
+        matrix.close()
+
+
+class SparseDataMatrix(DataMatrix):
+    """A DataMatrix storing only the non-zero values.
+
+    Values are kept in coordinate format: sorted flat (C-order) indices
+    of the non-zero elements (NaN's included) and their values. Slices
+    and blocks are expanded to dense arrays on request only.
+
+    * max_value, value_range, histograms and the most common reductions
+    (sum, mean) are computed from the stored values.
+
+    * data_array expands the whole matrix (avoid if possible).
+
+    * The data are read-only.
+    """
+    # Approximate size of dense blocks yielded by iter_blocks (in bytes)
+    BLOCK_SIZE = 1 << 26
+
+    def __init__(self, shape, indices, values, header=None):
+        DataMatrix.__init__(self, header=header)
+        self._shape = tuple(int(size) for size in shape)
+        self.indices = numpy.asarray(indices, dtype=numpy.int64)
+        self.values = numpy.asarray(values)
+
+    @classmethod
+    def from_array(cls, array, header=None):
+        """Sparse copy of a dense array."""
+        flat = numpy.asarray(array).reshape(-1)
+        indices = numpy.flatnonzero(flat)
+        return cls(array.shape, indices, flat[indices], header)
+
+    @property
+    def data_array(self):
+        return self._block(tuple((0, size) for size in self.shape))
+
+    @property
+    def shape(self):
+        return self._shape
+
+    @property
+    def size(self):
+        return int(numpy.prod(self.shape))
+
+    @property
+    def dtype(self):
+        return self.values.dtype
+
+    @property
+    def nbytes(self):
+        return self.indices.nbytes + self.values.nbytes
+
+    def astype(self, dtype):
+        return SparseDataMatrix(self.shape, self.indices,
+                                self.values.astype(dtype), self.header)
+
+    @property
+    def density(self):
+        """Fraction of the stored (non-zero) elements."""
+        return float(len(self.values)) / max(1, self.size)
+
+    def copy(self):
+        return SparseDataMatrix(self.shape, self.indices.copy(),
+                                self.values.copy(), self.header)
+
+    def _block(self, bounds):
+        """Dense block, bounds being ((x0, x1), (y0, y1), (z0, z1))."""
+        block = numpy.zeros([high - low for low, high in bounds],
+                            dtype=self.values.dtype)
+        if not block.size:
+            return block
+        # Indices are sorted => x-range is a contiguous part
+        plane_size = self.shape[1] * self.shape[2]
+        first, last = numpy.searchsorted(
+            self.indices, (bounds[0][0] * plane_size,
+                           bounds[0][1] * plane_size))
+        coords = numpy.unravel_index(self.indices[first:last], self.shape)
+        mask = numpy.ones(last - first, dtype=bool)
+        for axis in (1, 2):
+            low, high = bounds[axis]
+            if (low, high) != (0, self.shape[axis]):
+                mask &= (coords[axis] >= low) & (coords[axis] < high)
+        block[tuple(c[mask] - low for c, (low, high)
+                    in zip(coords, bounds))] = self.values[first:last][mask]
+        return block
+
+    def __getitem__(self, index):
+        if not isinstance(index, tuple):
+            index = (index,)
+        relative = len(index) == 4 and index[3]
+        index = index[:3] + (slice(None),) * (3 - len(index[:3]))
+        bounds = []
+        shape = []
+        for i, size in zip(index, self.shape):
+            if isinstance(i, slice) and i.step in (None, 1):
+                start, stop, step = i.indices(size)
+                bounds.append((start, max(start, stop)))
+                shape.append(bounds[-1][1] - start)
+            elif isinstance(i, numbers.Integral):
+                i = int(i) + size if i < 0 else int(i)
+                if not 0 <= i < size:
+                    raise IndexError("Index out of range.")
+                bounds.append((i, i + 1))
+            else:
+                # Fancy indexing
+                data = self.data_array[index]
+                break
+        else:
+            data = self._block(bounds).reshape(shape)
+        if relative:
+            data = data / self.max_value
+        return data
+
+    def __setitem__(self, index, value):
+        raise Exception("Sparse data are read-only.")
+
+    def apply_block(self, offset, block, accumulate=False):
+        raise Exception("Sparse data are read-only.")
+
+    def apply_sparse(self, indices, values, accumulate=False):
+        raise Exception("Sparse data are read-only.")
+
+    def grow(self, shape):
+        raise Exception("Sparse data are read-only.")
+
+    def value_at(self, x, y, z):
+        flat = numpy.ravel_multi_index((x, y, z), self.shape)
+        i = numpy.searchsorted(self.indices, flat)
+        if i < len(self.indices) and self.indices[i] == flat:
+            return self.values[i]
+        return self.values.dtype.type(0)
+
+    def relative_value_at(self, x, y, z):
+        return self.value_at(x, y, z) / self.max_value
+
+    def iter_blocks(self, multiple=1):
+        plane_size = self.values.dtype.itemsize * self.size // self.size_x
+        step = max(1, self.BLOCK_SIZE // max(1, plane_size))
+        step = max(multiple, step // multiple * multiple)
+        for x0 in range(0, self.size_x, step):
+            x1 = min(x0 + step, self.size_x)
+            yield x0, self._block(((x0, x1), (0, self.size_y),
+                                   (0, self.size_z)))
+
+    @property
+    def _has_zeros(self):
+        return len(self.values) < self.size
+
+    def _compute_max(self):
+        max_ = _abs_max(self.values)
+        if self._has_zeros:
+            max_ = max(max_, 0.0)
+        return max_ if max_ > -numpy.inf else numpy.nan
+
+    @property
+    def max_value(self):
+        return self._cached("_maxValue", self._compute_max)
+
+    def compute_max_value(self, progress=None):
+        # Computed from the stored values (quickly)
+        return self.max_value
+
+    def value_range(self, positive=False):
+        values = self.values[~numpy.isnan(self.values)]
+        if positive:
+            values = values[values > 0]
+        elif self._has_zeros:
+            values = numpy.append(values, 0)
+        if not values.size:
+            return numpy.nan, numpy.nan
+        return values.min(), values.max()
+
+    @staticmethod
+    def _bin_of_zero(edges):
+        """Index of the bin containing 0 (None if outside)."""
+        bins = len(edges) - 1
+        index = numpy.searchsorted(edges, 0.0, side="right") - 1
+        if edges[-1] == 0:
+            index = bins - 1
+        return index if 0 <= index < bins else None
+
+    def histogram(self, bins=100):
+        if numpy.ndim(bins) == 0:
+            min_, max_ = self.value_range()
+            edges = numpy.histogram([], bins, (min_, max_))[1]
+        else:
+            edges = numpy.asarray(bins, dtype=float)
+        values = self.values[~numpy.isnan(self.values)]
+        counts = numpy.histogram(values, edges)[0]
+        zero_bin = self._bin_of_zero(edges)
+        if zero_bin is not None:
+            counts[zero_bin] += self.size - len(self.values)
+        return counts, edges
+
+    def slice_histograms(self, axis, edges):
+        edges = numpy.asarray(edges, dtype=float)
+        bins = len(edges) - 1
+        slices = self.shape[axis]
+        slice_index = numpy.unravel_index(self.indices, self.shape)[axis]
+        bin_index = numpy.searchsorted(edges, self.values, side="right") - 1
+        bin_index[self.values == edges[-1]] = bins - 1   # Last bin closed
+        valid = (bin_index >= 0) & (bin_index < bins)
+        counts = numpy.bincount((slice_index * bins + bin_index)[valid],
+                                minlength=slices * bins)
+        counts = counts.reshape(slices, bins)
+        zero_bin = self._bin_of_zero(edges)
+        if zero_bin is not None:
+            counts[:, zero_bin] += (self.size // slices -
+                                    numpy.bincount(slice_index,
+                                                   minlength=slices))
+        return counts
+
+    @property
+    def relative(self):
+        return SparseDataMatrix(self.shape, self.indices,
+                                self.values / self.max_value, self.header)
+
+    # Reductions computed directly from the stored values
+    SPARSE_REDUCTIONS = ("sum", "nansum", "mean", "nanmean")
+
+    def reduced(self, indices=(1, 1, 1), method="sum", edges="strict",
+                dtype=None):
+        if method not in self.SPARSE_REDUCTIONS:
+            return DataMatrix.reduced(self, indices, method, edges, dtype)
+        factors = tuple(int(i) for i in indices)
+        shape = reduced_shape(self.shape, factors, edges)
+        boxes = [c // f for c, f in
+                 zip(numpy.unravel_index(self.indices, self.shape), factors)]
+        inside = numpy.ones(len(self.indices), dtype=bool)
+        for box, size in zip(boxes, shape):
+            inside &= box < size      # edges="truncate"
+        flat = numpy.ravel_multi_index([box[inside] for box in boxes], shape)
+        values = self.values[inside]
+        nan = numpy.isnan(values)
+        length = int(numpy.prod(shape))
+        if method.startswith("nan"):
+            result = numpy.bincount(flat[~nan], values[~nan], minlength=length)
+        else:
+            result = numpy.bincount(flat, values, minlength=length)
+        if method in ("mean", "nanmean"):
+            # Number of the elements in each box (smaller at the edges)
+            count = numpy.ones(shape)
+            for axis, (size, f, n) in enumerate(zip(self.shape, factors,
+                                                    shape)):
+                sizes = numpy.minimum(f, size - numpy.arange(n) * f)
+                count = count * sizes.reshape([-1 if i == axis else 1
+                                               for i in range(3)])
+            count = count.reshape(-1)
+            if method == "nanmean":
+                count -= numpy.bincount(flat[nan], minlength=length)
+            with numpy.errstate(invalid="ignore", divide="ignore"):
+                result = result / count
+            result[count == 0] = numpy.nan
+        result = result.astype(self._result_dtype(dtype, method))
+        return DataMatrix(result.reshape(shape), header=self.header)
+
+    def _combined(self, other, sign, dtype):
+        indices = numpy.concatenate((self.indices, other.indices))
+        values = numpy.concatenate((self.values, sign * other.values))
+        indices, inverse = numpy.unique(indices, return_inverse=True)
+        # bincount sums in float64
+        values = numpy.bincount(inverse, values).astype(dtype or values.dtype)
+        nonzero = values != 0
+        return SparseDataMatrix(self.shape, indices[nonzero], values[nonzero],
+                                self.header)
+
+    def add(self, other, dtype=None):
+        if isinstance(other, SparseDataMatrix) and other.shape == self.shape:
+            return self._combined(other, 1, dtype)
+        return DataMatrix.add(self, other, dtype)
+
+    def subtract(self, other, dtype=None):
+        if isinstance(other, SparseDataMatrix) and other.shape == self.shape:
+            return self._combined(other, -1, dtype)
+        return DataMatrix.subtract(self, other, dtype)
+
+    def multiply(self, coefficient, dtype=None):
+        dtype = dtype or numpy.result_type(self.values, coefficient)
+        values = numpy.multiply(self.values, coefficient, dtype=numpy.float64)
+        return SparseDataMatrix(self.shape, self.indices,
+                                values.astype(dtype, copy=False), self.header)
+
+
+class H5DataMatrix(DataMatrix):
+    """A DataMatrix backed by an open HDF5 dataset.
+
+    Nothing is read in advance, indexing (and therefore slicing via
+    DataMatrixSlice2D) reads only the requested hyperslab. Whole-matrix
+    operations (max_value, histogram) go through the data in blocks
+    aligned with the chunks of the dataset.
+
+    * data_array reads the whole dataset into memory (avoid if possible).
+
+    * close() closes the underlying file.
+    """
+    # Approximate size of blocks read by iter_blocks (in bytes)
+    BLOCK_SIZE = 1 << 26
+
+    def __init__(self, dataset, h5file=None, header=None):
+        DataMatrix.__init__(self, header=header)
+        self.dataset = dataset
+        self.h5file = h5file
+
+    @property
+    def data_array(self):
+        return self.dataset[...]
+
+    @property
+    def shape(self):
+        return self.dataset.shape
+
+    @property
+    def size(self):
+        return self.dataset.size
+
+    @property
+    def dtype(self):
+        return self.dataset.dtype
+
+    @property
+    def nbytes(self):
+        # Nothing is held in the memory
+        return 0
+
+    def __getitem__(self, index):
+        if not hasattr(index, "__len__"):
+            return self.dataset[index]
+        data = self.dataset[tuple(index[0:3])]
+        if len(index) == 4 and index[3]:
+            data = data / self.max_value
+        return data
+
+    def __setitem__(self, index, value):
+        raise Exception("HDF5 data are read-only.")
+
+    def apply_block(self, offset, block, accumulate=False):
+        raise Exception("HDF5 data are read-only.")
+
+    def apply_sparse(self, indices, values, accumulate=False):
+        raise Exception("HDF5 data are read-only.")
+
+    def grow(self, shape):
+        raise Exception("HDF5 data are read-only.")
+
+    def value_at(self, x, y, z):
+        return self.dataset[x, y, z]
+
+    def relative_value_at(self, x, y, z):
+        return self.value_at(x, y, z) / self.max_value
+
+    def iter_blocks(self, multiple=1):
+        plane_size = self.dataset.dtype.itemsize * self.size // self.size_x
+        step = max(1, self.BLOCK_SIZE // max(1, plane_size))
+        if self.dataset.chunks:
+            chunk = self.dataset.chunks[0]
+            step = max(chunk, step // chunk * chunk)
+        step = max(multiple, step // multiple * multiple)
+        for x0 in range(0, self.size_x, step):
+            yield x0, self.dataset[x0:x0 + step]
+
+    def close(self):
+        if self.h5file:
+            self.h5file.close()
+            self.h5file = None
+
 
 class DataMatrixSlice2D(object):
     """A 2D slice from a DataMatrix."""
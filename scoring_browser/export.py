@@ -0,0 +1,115 @@
+#
+# scoring_browser --- Simple Qt application for browsing
+# scoring outputs in Geant4
+#
+# Copyright (C) 2012-2014 Jan Pipek
+# (jan.pipek@gmail.com)
+#
+# This file may be distributed without limitation.
+#
+"""Writing matrices and 2D tables to files (no GUI needed)."""
+import os
+import cgi
+import numpy
+
+from data_matrix import HDF5_ENABLED
+from heatmap import HeatmapColors
+
+if HDF5_ENABLED:
+    import h5py
+
+# Formats of write_matrix by file extension
+MATRIX_FORMATS = {
+    ".npy": "npy",
+    ".h5": "hdf5",
+    ".hdf5": "hdf5",
+    ".txt": "text",
+    ".csv": "text",
+    ".dat": "text"
+}
+
+
+def write_matrix(matrix, file_name, dataset="data"):
+    """Write a whole matrix, the format is given by the extension.
+
+    * .npy - numpy array
+
+    * .h5, .hdf5 - dataset in an HDF5 file
+
+    * .txt, .csv, .dat - text format of Geant4 scoring
+
+    :param dataset: path of the dataset in HDF5 files
+    """
+    extension = os.path.splitext(file_name)[1].lower()
+    format_ = MATRIX_FORMATS.get(extension)
+    if format_ == "npy":
+        # Block by block (works for HDF5 matrices as well)
+        array = numpy.lib.format.open_memmap(
+            file_name, mode="w+", dtype=matrix.dtype, shape=matrix.shape)
+        for x0, block in matrix.iter_blocks():
+            array[x0:x0 + len(block)] = block
+        del array
+    elif format_ == "hdf5":
+        if not HDF5_ENABLED:
+            raise Exception("HDF5 library not found => writing disabled.")
+        with h5py.File(file_name, "a") as f:
+            if dataset in f:
+                del f[dataset]
+            out = f.create_dataset(dataset, shape=matrix.shape,
+                                   dtype=matrix.dtype)
+            for x0, block in matrix.iter_blocks():
+                out[x0:x0 + len(block)] = block
+    elif format_ == "text":
+        write_scoring_text(matrix, file_name)
+    else:
+        raise ValueError("Unknown format: " + file_name)
+
+
+def write_scoring_text(matrix, file_name, value_format="%.12g"):
+    """Write a matrix in the text format of Geant4 scoring.
+
+    Lines "iX,iY,iZ,value" are preceded by the header of the matrix
+    (or a minimal one).
+    """
+    with open(file_name, "w") as f:
+        header = matrix.header or "# iX, iY, iZ, value"
+        f.write(header.rstrip("\n") + "\n")
+        row_format = "%d,%d,%d," + value_format
+        for x0, block in matrix.iter_blocks():
+            indices = numpy.indices(block.shape).reshape(3, -1)
+            indices[0] += x0
+            columns = numpy.column_stack((indices.T, block.reshape(-1)))
+            numpy.savetxt(f, columns, fmt=row_format)
+
+
+def write_csv_table(file_name, data):
+    """Write a 2D slice (indexed [column, row]) as a CSV table."""
+    with open(file_name, "w") as f:
+        for row in range(0, data.shape[1]):
+            f.write("".join(str(value) + "," for value in data[:, row]))
+            f.write("\n")
+
+
+def write_html_table(file_name, data, color_indices, heatmap,
+                     plane_name="xy", format_value=str):
+    """Write a 2D slice (indexed [column, row]) as an HTML table.
+
+    :param color_indices: heatmap indices of all cells
+    :param heatmap: HeatmapColors providing the colours
+    """
+    backgrounds = HeatmapColors.to_hex(heatmap.background)
+    foregrounds = HeatmapColors.to_hex(heatmap.foreground)
+    with open(file_name, "w") as f:
+        f.write("<table>\n<tr><th></th>")
+        for column in range(0, data.shape[0]):
+            f.write("<th>%s = %d</th>" % (plane_name[0], column))
+        f.write("</tr>\n")
+        for row in range(0, data.shape[1]):
+            f.write("<tr><th>%s = %d</th>" % (plane_name[1], row))
+            for column in range(0, data.shape[0]):
+                index = color_indices[column, row]
+                f.write('<td style="background: %s; color: %s">%s</td>'
+                        % (backgrounds[index], foregrounds[index],
+                           cgi.escape(format_value(data[column, row]))))
+            f.write("</tr>\n")
+        f.write("</table>\n")
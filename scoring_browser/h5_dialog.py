@@ -17,7 +17,7 @@ class H5Dialog(QtGui.QDialog):
         super(H5Dialog, self).__init__(parent)
         self.setModal(True)
 
-        f = h5py.File(file_name)
+        f = h5py.File(file_name, "r")
 
         # Tree Widget
         def on_item_selection_change():
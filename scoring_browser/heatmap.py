@@ -0,0 +1,67 @@
+#
+# scoring_browser --- Simple Qt application for browsing
+# scoring outputs in Geant4
+#
+# Copyright (C) 2012-2014 Jan Pipek
+# (jan.pipek@gmail.com)
+#
+# This file may be distributed without limitation.
+#
+import colorsys
+import numpy
+
+
+class HeatmapColors(object):
+    """Colour scheme of the data table as a lookup table.
+
+    Positive relative values go from white through red to black,
+    negative ones from white through blue to black, NaN's are yellow.
+    The text colour is white on dark backgrounds.
+
+    Relative values (in [-1, 1]) are quantized to 2 * levels - 1 steps.
+    indices() maps a whole array to the indices in the table at once,
+    background and foreground are (N, 4) arrays of RGBA bytes.
+    It does not depend on Qt, so it can be used for exports as well.
+    """
+    NAN_INDEX = 0
+
+    def __init__(self, levels=256):
+        self.levels = levels
+        values = self.index_values()
+
+        self.background = numpy.empty((2 * levels, 4), dtype=numpy.uint8)
+        self.foreground = numpy.empty((2 * levels, 4), dtype=numpy.uint8)
+        for i, value in enumerate(values):
+            if numpy.isnan(value):
+                rgb = (1.0, 1.0, 0.0)
+                text_rgb = (0, 0, 0)
+            else:
+                hue = 0.0 if value > 0 else 0.66
+                rgb = colorsys.hls_to_rgb(hue, 1.0 - abs(value), 1.0)
+                if abs(value) > 0.33:
+                    text_rgb = (255, 255, 255)
+                else:
+                    text_rgb = (32, 32, 32)
+            self.background[i] = [int(round(c * 255)) for c in rgb] + [255]
+            self.foreground[i] = list(text_rgb) + [255]
+
+    def index_values(self):
+        """Relative value represented by each index."""
+        steps = numpy.arange(-(self.levels - 1), self.levels)
+        return numpy.concatenate(([numpy.nan],
+                                  steps / float(self.levels - 1)))
+
+    def indices(self, relative):
+        """Table indices for an array of relative values."""
+        relative = numpy.asarray(relative, dtype=float)
+        nan = numpy.isnan(relative)
+        relative = numpy.clip(numpy.where(nan, 0.0, relative), -1.0, 1.0)
+        result = numpy.rint(relative * (self.levels - 1)).astype(numpy.int32)
+        result += self.levels
+        result[nan] = self.NAN_INDEX
+        return result.astype(numpy.uint16)
+
+    @staticmethod
+    def to_hex(colors):
+        """List of "#rrggbb" strings for an (N, 4) array of colours."""
+        return ["#%02x%02x%02x" % tuple(color[:3]) for color in colors]
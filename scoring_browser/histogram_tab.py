@@ -7,52 +7,159 @@
 #
 # This file may be distributed without limitation.
 #
-from PyQt4 import QtGui
+from PyQt4 import QtGui, QtCore
 
 import numpy as np
 import matplotlib
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_qt4agg import FigureCanvasQTAgg as FigureCanvas
 
-class HistogramTab(QtGui.QWidget):
-    """ Tab displaying the histogram of values."""
+from slice_tab import SliceTab
+from histograms import (Binning, compute_histogram, cached_histogram,
+                        store_histogram)
+
+
+class HistogramWorker(QtCore.QThread):
+    """ Thread computing histograms outside of the GUI thread.
+
+    The request is a (matrix, binning, relative, axis) tuple,
+    see histograms.compute_histogram. The matrix is not copied, it can
+    be changed in the GUI thread meanwhile: the version of the matrix
+    is emitted with the result and outdated results are dropped.
+    """
+    computed = QtCore.pyqtSignal(object, object, object)  # + version
+
+    def __init__(self, parent=None):
+        QtCore.QThread.__init__(self, parent)
+        self.request = None
+        self.version = None
+
+    def compute(self, request):
+        """Start computing (called in the GUI thread)."""
+        self.request = request
+        self.version = request[0].version
+        self.start()
+
+    def run(self):
+        request = self.request
+        try:
+            result = compute_histogram(*request)
+        except Exception as exc:
+            result = exc
+        self.computed.emit(request, self.version, result)
+
+
+class HistogramTab(SliceTab):
+    """ Tab displaying the histogram of values.
+
+    Either of the whole matrix or of the current slice (histograms
+    of all slices along the axis are computed at once so that the
+    slider can be followed without delay).
+    """
     def __init__(self, parent):
-        QtGui.QWidget.__init__(self, parent)
-        layout = QtGui.QVBoxLayout(self)
+        SliceTab.__init__(self, parent)
 
         self.figure = plt.Figure()
         self.canvas = FigureCanvas(self.figure)
+        self.layout.addWidget(self.canvas)
+
+        # Binning
+        self.toolBar.addSeparator()
+        self.sliceCheckBox = QtGui.QCheckBox("Slice Only")
+        self.toolBar.addWidget(self.sliceCheckBox)
+        self.toolBar.addSeparator()
+        self.toolBar.addWidget(QtGui.QLabel("Bins: "))
+        self.binsSpinBox = QtGui.QSpinBox()
+        self.binsSpinBox.setRange(1, 10000)
+        self.binsSpinBox.setValue(100)
+        self.toolBar.addWidget(self.binsSpinBox)
+        self.logCheckBox = QtGui.QCheckBox("Log")
+        self.toolBar.addWidget(self.logCheckBox)
+        self.toolBar.addWidget(QtGui.QLabel(" Edges: "))
+        self.edgesEdit = QtGui.QLineEdit()
+        self.edgesEdit.setToolTip("Explicit bin edges (space-separated)")
+        self.toolBar.addWidget(self.edgesEdit)
+
+        self.sliceCheckBox.stateChanged.connect(self.update_histogram)
+        self.binsSpinBox.valueChanged.connect(self.update_histogram)
+        self.logCheckBox.stateChanged.connect(self.update_histogram)
+        self.edgesEdit.editingFinished.connect(self.update_histogram)
 
-        layout.addWidget(self.canvas)
+        self.worker = HistogramWorker(self)
+        self.worker.computed.connect(self.on_histogram_computed)
+        self.worker.finished.connect(self.on_worker_finished)
+        self._pending_request = None
+
+        for signal in self.all_model_signals:
+            signal.connect(self.update_histogram)
+        self.data_changed.connect(self.on_data_changed)
 
         self.update_histogram()
 
     @property
-    def matrix(self):
-        if not hasattr(self, "_matrix"):
-            return None
-        return self._matrix
-
-    @matrix.setter
-    def matrix(self, value):
-        self._matrix = value
-        self.update_histogram()
+    def binning(self):
+        try:
+            edges = [float(s) for s in str(self.edgesEdit.text()).split()]
+        except ValueError:
+            edges = None
+        if edges and len(edges) < 2:
+            edges = None
+        return Binning(self.binsSpinBox.value(),
+                       self.logCheckBox.isChecked(), edges)
+
+    @property
+    def current_request(self):
+        axis = self.slice.axis if self.sliceCheckBox.isChecked() else None
+        return (self.matrix, self.binning, self.relative, axis)
 
     def update_histogram(self):
-        self.figure.clear()
-        if self.matrix:
-            steps = 100
-            axis = self.figure.add_subplot(111)
-            data = np.histogram(self.matrix.data_array, steps)
-            # print data
-            y = data[0]
-            x = data[1][:-1] # data[1][1:]
+        if not self.matrix:
+            self.figure.clear()
+            self.canvas.draw()
+            return
+        request = self.current_request
+        result = cached_histogram(*request)
+        if result is None:
+            self.request_histogram(request)
+        else:
+            self.plot_histogram(result)
 
-            bar_width = float(data[1][-1] - data[1][0]) / steps
+    def on_data_changed(self, region):
+        # Histogram of the whole matrix changes with any change
+        if not self.sliceCheckBox.isChecked() or self.slice_affected(region):
+            self.update_histogram()
 
-            axis.bar(x, y, align="center", width=bar_width)
-        self.canvas.draw()
+    def request_histogram(self, request):
+        """ Compute the histogram in the worker thread."""
+        if self.worker.isRunning():
+            self._pending_request = request
+        else:
+            self.worker.compute(request)
+
+    def on_histogram_computed(self, request, version, result):
+        if version != request[0].version:
+            # The matrix changed meanwhile (a new request follows)
+            return
+        if isinstance(result, Exception):
+            self.parent.set_status("Histogram failed: " + str(result))
+            return
+        store_histogram(*(request + (result, version)))
+        if request == self.current_request:
+            self.plot_histogram(result)
+
+    def on_worker_finished(self):
+        request, self._pending_request = self._pending_request, None
+        if request and cached_histogram(*request) is None:
+            self.request_histogram(request)
 
+    def plot_histogram(self, result):
+        counts, edges = result
+        if counts.ndim == 2:
+            counts = counts[self.slice_index]
 
-    #def setText(self, text):
-    #    self.textEdit.setText(text)
+        self.figure.clear()
+        axis = self.figure.add_subplot(111)
+        axis.bar(edges[:-1], counts, width=np.diff(edges), align="edge")
+        if self.logCheckBox.isChecked() and edges[0] > 0:
+            axis.set_xscale("log")
+        self.canvas.draw()
@@ -0,0 +1,96 @@
+#
+# scoring_browser --- Simple Qt application for browsing
+# scoring outputs in Geant4
+#
+# Copyright (C) 2012-2014 Jan Pipek
+# (jan.pipek@gmail.com)
+#
+# This file may be distributed without limitation.
+#
+import numpy
+
+
+class Binning(object):
+    """Specification of histogram bins.
+
+    Either a number of equal bins (linear or logarithmic) spanning
+    the range of values or explicit bin edges. Binnings are hashable
+    so that they can be used in cache keys.
+    """
+    def __init__(self, bins=100, log=False, edges=None):
+        self.bins = bins
+        self.log = log
+        self.edges = tuple(edges) if edges else None
+
+    def _key(self):
+        if self.edges:
+            return (self.edges,)
+        return (self.bins, self.log)
+
+    def __eq__(self, other):
+        return isinstance(other, Binning) and self._key() == other._key()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def __repr__(self):
+        if self.edges:
+            return "Binning(edges=%s)" % (self.edges,)
+        return "Binning(%d, log=%s)" % (self.bins, self.log)
+
+    def compute_edges(self, matrix, scale=1.0):
+        """Bin edges (in the units of the matrix values).
+
+        :param scale: explicit edges are multiplied by it
+            (i.e. max_value for edges expressed in relative values)
+        """
+        if self.edges:
+            return numpy.array(self.edges, dtype=float) * scale
+        min_, max_ = matrix.value_range(positive=self.log)
+        if numpy.isnan(min_):
+            min_, max_ = (1.0, 10.0) if self.log else (0.0, 1.0)
+        if self.log:
+            return numpy.logspace(numpy.log10(min_), numpy.log10(max_),
+                                  self.bins + 1)
+        return numpy.histogram([], self.bins, (min_, max_))[1]
+
+
+def compute_histogram(matrix, binning, relative=False, axis=None):
+    """Histogram of a matrix.
+
+    :param relative: edges are expressed in relative values
+    :param axis: if set, histograms of all slices along this axis
+        are computed (in one pass)
+    :returns: (counts, edges), counts being 2D (slice, bin) for an axis
+    """
+    scale = matrix.max_value if relative else 1.0
+    edges = binning.compute_edges(matrix, scale)
+    if axis is None:
+        counts = matrix.histogram(edges)[0]
+    else:
+        counts = matrix.slice_histograms(axis, edges)
+    return counts, edges / scale
+
+
+def cached_histogram(matrix, binning, relative=False, axis=None):
+    """Already computed histogram of a matrix (or None)."""
+    cache = matrix.derived.get("histograms", {})
+    return cache.get((binning, relative, axis))
+
+
+def store_histogram(matrix, binning, relative, axis, result, version=None):
+    """Cache a histogram computed by compute_histogram.
+
+    The cache lives in matrix.derived, i.e. it is dropped when
+    the matrix changes.
+
+    :param version: version of the matrix the histogram was computed
+        for (see DataMatrix.version), outdated results are not stored
+    """
+    if version is not None and version != matrix.version:
+        return
+    cache = matrix.derived.setdefault("histograms", {})
+    cache[(binning, relative, axis)] = result
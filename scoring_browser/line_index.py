@@ -0,0 +1,224 @@
+#
+# scoring_browser --- Simple Qt application for browsing
+# scoring outputs in Geant4
+#
+# Copyright (C) 2012-2014 Jan Pipek
+# (jan.pipek@gmail.com)
+#
+# This file may be distributed without limitation.
+#
+import os
+import mmap
+import numpy
+
+
+class LineIndex(object):
+    """Random access to lines of a (huge) text file.
+
+    The file is memory-mapped, only offsets of every STEP-th line are
+    kept (the lines in between are found by a short scan), so the index
+    takes a few MB even for multi-gigabyte files.
+
+    The index is built in one pass, either from the blocks of text
+    as they are read by someone else (append + finish, e.g. as the
+    source of DataMatrixLoader.from_csv) or by scanning the file (build).
+    """
+    # Offsets of lines 0, STEP, 2 * STEP, ... are stored
+    STEP = 64
+
+    # Size of the parts of the file scanned at once
+    CHUNK_SIZE = 1 << 24
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.line_count = 0
+        self._checkpoints = numpy.zeros(1, dtype=numpy.int64)
+        self._parts = [self._checkpoints]
+        self._newlines = 0
+        self._size = 0
+        self._last_char = None
+        self._file = None
+        self._mmap = None
+
+    def __len__(self):
+        return self.line_count
+
+    @property
+    def empty(self):
+        """Whether nothing has been indexed yet."""
+        return self._size == 0
+
+    @property
+    def size(self):
+        """Number of indexed bytes."""
+        return self._size
+
+    def append(self, block):
+        """Index the next block of the file text."""
+        self._index_chunk(numpy.frombuffer(block, dtype=numpy.uint8))
+
+    def _index_chunk(self, chunk):
+        if not len(chunk):
+            return
+        positions = numpy.flatnonzero(chunk == ord("\n"))
+        # Line g + 1 starts after the g-th newline
+        first = (self.STEP - 1 - self._newlines) % self.STEP
+        starts = positions[first::self.STEP] + self._size + 1
+        self._parts.append(starts.astype(numpy.int64))
+        self._newlines += len(positions)
+        self._size += len(chunk)
+        self._last_char = chunk[-1]
+
+    def build(self):
+        """Index the whole file (or its part after the indexed bytes)."""
+        self._open()
+        if self._mmap is not None:
+            data = numpy.frombuffer(self._mmap, dtype=numpy.uint8)
+            for start in range(self._size, len(data), self.CHUNK_SIZE):
+                self._index_chunk(data[start:start + self.CHUNK_SIZE])
+        self.finish()
+
+    def refresh(self):
+        """Index data appended to the file since it was indexed."""
+        self.close()
+        self.build()
+
+    def finish(self):
+        """Make the index usable (after all blocks were appended)."""
+        # The last one can point after the final newline (no line yet)
+        self._checkpoints = numpy.concatenate(self._parts)
+        self._parts = [self._checkpoints]
+        self.line_count = self._newlines
+        if self._size and self._last_char != ord("\n"):
+            self.line_count += 1
+        self._open()
+
+    def _open(self):
+        if self._file is None:
+            self._file = open(self.file_name, "rb")
+            if os.fstat(self._file.fileno()).st_size:
+                self._mmap = mmap.mmap(self._file.fileno(), 0,
+                                       access=mmap.ACCESS_READ)
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def offset(self, line):
+        """Offset of the start of a line in the file."""
+        if not 0 <= line < max(1, self.line_count):
+            raise IndexError("Line out of range.")
+        position = int(self._checkpoints[line // self.STEP])
+        for i in range(line % self.STEP):
+            position = self._mmap.find(b"\n", position) + 1
+        return position
+
+    def _end(self, position):
+        end = self._mmap.find(b"\n", position)
+        return self._size if end < 0 else end
+
+    def line(self, line):
+        """Text of a line (without the newline)."""
+        if self._mmap is None:
+            return ""
+        start = self.offset(line)
+        return self._mmap[start:self._end(start)].rstrip(b"\r")
+
+    def lines(self, start, count):
+        """Text of count lines starting with start."""
+        count = min(count, self.line_count - start)
+        if count <= 0 or self._mmap is None:
+            return []
+        begin = self.offset(start)
+        end = begin
+        for i in range(count):
+            end = self._end(end) + 1
+        return [line.rstrip(b"\r")
+                for line in self._mmap[begin:end].split(b"\n")[:count]]
+
+    def line_at(self, position):
+        """Number of the line containing the offset."""
+        checkpoint = int(numpy.searchsorted(self._checkpoints, position,
+                                            side="right")) - 1
+        start = int(self._checkpoints[checkpoint])
+        return (checkpoint * self.STEP +
+                self._mmap[start:position].count(b"\n"))
+
+    def find(self, text, start_line=0, progress=None):
+        """Number of the first line at or after start_line containing text.
+
+        The file is searched in chunks of CHUNK_SIZE.
+
+        :param progress: callable accepting (offset, file size), called
+            after each chunk (it can stop the search by raising)
+        :returns: line number or None
+        """
+        if self._mmap is None or start_line >= self.line_count:
+            return None
+        position = self.offset(start_line)
+        while position < self._size:
+            end = min(self._size, position + self.CHUNK_SIZE + len(text))
+            found = self._mmap.find(text, position, end)
+            if found >= 0:
+                return self.line_at(found)
+            position += self.CHUNK_SIZE
+            if progress:
+                progress(min(position, self._size), self._size)
+        return None
+
+    @property
+    def header_line_count(self):
+        """Number of the comment lines at the start of the file."""
+        count = 0
+        while count < self.line_count and self.line(count).startswith(b"#"):
+            count += 1
+        return count
+
+    def voxel_line(self, voxel, shape):
+        """Number of the line with the value of a voxel.
+
+        Geant4 writes the voxels in order (x being the slowest index),
+        which is checked; the line is searched for otherwise.
+
+        :returns: line number or None
+        """
+        prefix = ",".join(str(int(i)) for i in voxel) + ","
+        line = self.header_line_count + int(numpy.ravel_multi_index(
+            tuple(int(i) for i in voxel), shape))
+        if (line < self.line_count and
+                self.line(line).replace(b" ", b"").startswith(prefix)):
+            return line
+        found = self.find(b"\n" + prefix)
+        return None if found is None else found + 1
+
+
+class TextLines(object):
+    """Lines of a short text with the interface of LineIndex."""
+    def __init__(self, text):
+        self._lines = text.splitlines()
+        self.line_count = len(self._lines)
+
+    def __len__(self):
+        return self.line_count
+
+    def line(self, line):
+        return self._lines[line]
+
+    def lines(self, start, count):
+        return self._lines[start:start + count]
+
+    def find(self, text, start_line=0, progress=None):
+        for i in range(start_line, self.line_count):
+            if text in self._lines[i]:
+                return i
+        return None
+
+    def voxel_line(self, voxel, shape):
+        return None
+
+    def close(self):
+        pass
@@ -1,20 +1,159 @@
 import zmq
+import json
 
 import server
 import message
 
 class Client(object):
-    def __init__(self, ip="127.0.0.1", port=server.DEFAULT_PORT):
+    '''Client sending data to a Server.
+
+    The connection (context + socket) is created with the first message
+    and kept for the following ones. If no reply comes within the timeout,
+    the socket is replaced by a new one (a REQ socket cannot send again
+    before it receives a reply) and the message is sent again.
+
+    In the pipelined mode, a DEALER socket is used and messages are sent
+    without waiting for the replies (at most max_outstanding of them can
+    be unanswered). Call flush() to wait for all the replies.
+
+    With compression, larger arrays are compressed (see Message.as_frames).
+    If the server does not know the codec (UNKNOWN_CODEC_REPLY), the message
+    is sent again uncompressed and compression is switched off (not in
+    the pipelined mode). Other errors (e.g. a full queue) keep it on.
+    '''
+    def __init__(self, ip="127.0.0.1", port=server.DEFAULT_PORT,
+                 protocol=message.PROTOCOL_VERSION, timeout=10000,
+                 retries=2, pipelined=False, max_outstanding=16,
+                 compression=None, compression_level=1,
+                 compression_threshold=message.COMPRESSION_THRESHOLD):
+        '''
+        :param protocol: 2 = binary multipart messages,
+            1 = JSON (for servers of older versions)
+        :param timeout: How long to wait for a reply (in ms, -1 = forever).
+        :param retries: How many times to resend a message after a timeout
+            (accumulating deltas are never resent, the server could
+            have applied them already).
+        :param pipelined: Do not wait for a reply after each message.
+        :param max_outstanding: Maximum number of unanswered messages
+            in the pipelined mode.
+        :param compression: None or "zlib" (protocol 2 only).
+        :param compression_level: zlib level (1 = fast, 9 = small).
+        :param compression_threshold: Smaller arrays (in bytes) are
+            sent uncompressed.
+        '''
         self.port = port
         self.ip = ip
+        self.protocol = protocol
+        self.timeout = timeout
+        self.retries = retries
+        self.pipelined = pipelined
+        self.max_outstanding = max_outstanding
+        self.compression = compression
+        self.compression_level = compression_level
+        self.compression_threshold = compression_threshold
+        self.context = None
+        self.socket = None
+        self._outstanding = 0
+        self._failed = False
+
+    def _connect(self):
+        if self.context is None:
+            self.context = zmq.Context()
+        self.socket = self.context.socket(
+            zmq.DEALER if self.pipelined else zmq.REQ)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.setsockopt(zmq.RCVTIMEO, self.timeout)
+        self.socket.connect("tcp://%s:%d" % (self.ip, self.port))
+
+    def _reset(self):
+        '''Throw away the socket (e.g. after a timeout).'''
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+        self._outstanding = 0
+
+    def _frames(self, a_message, compression=None):
+        if self.protocol >= 2:
+            return a_message.as_frames(compression, self.compression_level,
+                                       self.compression_threshold)
+        else:
+            return [json.dumps(a_message.as_dict()).encode("utf-8")]
 
     def _send_message(self, a_message):
-        context = zmq.Context()
-        socket = context.socket(zmq.REQ) 
-        socket.connect("tcp://%s:%d" % (self.ip, self.port))
-        socket.send_json(a_message.as_dict())
-        response = socket.recv()
-        return response == "Ok"
+        frames = self._frames(a_message, self.compression)
+        if self.pipelined:
+            return self._send_pipelined(frames)
+        # Applying an increment twice would corrupt the data
+        retries = 0 if a_message.accumulate else self.retries
+        response = self._request(frames, retries)
+        if (response == message.UNKNOWN_CODEC_REPLY
+                and b'"codec"' in frames[0]):
+            # The server does not understand the compression
+            self.compression = None
+            response = self._request(self._frames(a_message), retries)
+        return response == b"Ok"
+
+    def _request(self, frames, retries=None):
+        '''Send frames and wait for the reply (None if none came).
+
+        :param retries: resends after a timeout (default: self.retries)
+        '''
+        if retries is None:
+            retries = self.retries
+        for attempt in range(retries + 1):
+            if self.socket is None:
+                self._connect()
+            try:
+                self.socket.send_multipart(frames, copy=False)
+                return self.socket.recv()
+            except zmq.Again:
+                self._reset()
+        return None
+
+    def _send_pipelined(self, frames):
+        if self.socket is None:
+            self._connect()
+        while self._outstanding >= self.max_outstanding:
+            self._receive_reply()
+        # Empty delimiter frame makes the message acceptable for REP
+        self.socket.send_multipart([b""] + frames, copy=False)
+        self._outstanding += 1
+        return not self._failed
+
+    def _receive_reply(self):
+        try:
+            reply = self.socket.recv_multipart()
+            self._outstanding -= 1
+            if reply[-1] != b"Ok":
+                self._failed = True
+        except zmq.Again:
+            self._failed = True
+            self._reset()
+
+    def flush(self):
+        '''Wait for replies to all pipelined messages.
+
+        :returns: True if all messages since the last flush were accepted.
+        '''
+        while self.socket is not None and self._outstanding:
+            self._receive_reply()
+        result, self._failed = not self._failed, False
+        return result
+
+    def close(self):
+        '''Wait for outstanding replies and close the connection.'''
+        if self.pipelined:
+            self.flush()
+        self._reset()
+        if self.context is not None:
+            self.context.term()
+            self.context = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
     def send(self, data, name="data"):
         '''Send data to the server.
@@ -23,4 +162,26 @@ class Client(object):
         :param name: name of the data
         '''
         a_message = message.Message(name, data)
-        return self._send_message(a_message)
\ No newline at end of file
+        return self._send_message(a_message)
+
+    def send_block(self, offset, data, name="data", accumulate=False):
+        '''Send new values of a block of already sent data.
+
+        :param offset: (x, y, z) index of the first element of the block
+        :param data: a 3D numpy array with the values
+        :param accumulate: the values are added to the current ones
+        '''
+        a_message = message.Message.block(
+            name, offset, data, "accumulate" if accumulate else "replace")
+        return self._send_message(a_message)
+
+    def send_sparse(self, indices, values, name="data", accumulate=True):
+        '''Send new values of individual voxels of already sent data.
+
+        :param indices: (n, 3) array of voxel indices
+        :param values: n values
+        :param accumulate: the values are added to the current ones
+        '''
+        a_message = message.Message.sparse(
+            name, indices, values, "accumulate" if accumulate else "replace")
+        return self._send_message(a_message)
@@ -1,12 +1,112 @@
 import numpy as np
 import base64
+import json
+import zlib
+import itertools
+
+# Version of the multipart (binary) protocol
+PROTOCOL_VERSION = 2
+
+# Codecs for compression of the array frames
+CODECS = ("zlib", "shuffle-zlib")
+
+# Smaller arrays (in bytes) are never compressed
+COMPRESSION_THRESHOLD = 1 << 16
+
+# Size of pieces of compressed data decompressed at once
+_DECOMPRESS_CHUNK = 1 << 20
+
+# Reply of the server to a message compressed by an unknown codec
+# (the client sends it again uncompressed)
+UNKNOWN_CODEC_REPLY = b"Error: Unknown codec."
+
+
+class UnknownCodec(ValueError):
+    '''The data are compressed by an unsupported codec.'''
+    pass
+
 
 class Message(object):
-    def __init__(self, name, data):
+    '''Named numpy array sent over the network.
+
+    There are two wire formats:
+
+    * protocol 1 - one JSON message with base64-encoded data
+      (as_dict / from_dict), kept for older clients
+
+    * protocol 2 - a small JSON header frame followed by the raw
+      buffer of the array in a second frame (as_frames / from_frames),
+      which can be sent and received without copying the data
+
+    Besides the whole matrix ("full" kind), a message can carry a change
+    of a matrix already sent under the same name (protocol 2 only):
+
+    * "block" - values of a rectangular block starting at offset
+
+    * "sparse" - values of individual voxels with (n, 3) indices
+      (sent in a third frame)
+
+    The change either replaces the values or is added to them
+    (mode "replace" or "accumulate").
+
+    Array frames of protocol 2 can be compressed with zlib, optionally
+    after shuffling the bytes (all first bytes of the elements, then
+    all second bytes etc.), which makes floats compress much better.
+    The codec is recorded in the header.
+    '''
+    KINDS = ("full", "block", "sparse")
+    MODES = ("replace", "accumulate")
+
+    def __init__(self, name, data, kind="full", mode="replace",
+                 offset=None, indices=None):
+        if kind not in self.KINDS:
+            raise ValueError("Unknown message kind: " + str(kind))
+        if mode not in self.MODES:
+            raise ValueError("Unknown mode: " + str(mode))
         self.name = name
         self.shape = data.shape
         self.dtype = str(data.dtype)
         self.data = data
+        self.kind = kind
+        self.mode = mode
+        self.offset = tuple(offset) if offset is not None else None
+        self.indices = indices
+
+    @classmethod
+    def block(cls, name, offset, data, mode="replace"):
+        return Message(name, data, "block", mode, offset=offset)
+
+    @classmethod
+    def sparse(cls, name, indices, values, mode="accumulate"):
+        indices = np.asarray(indices).reshape(-1, 3)
+        return Message(name, np.asarray(values).reshape(-1), "sparse", mode,
+                       indices=indices)
+
+    def astype(self, dtype):
+        '''The same message with data of another type.'''
+        return Message(self.name, np.asarray(self.data, dtype), self.kind,
+                       self.mode, self.offset, self.indices)
+
+    @property
+    def is_delta(self):
+        '''Whether the message changes an existing matrix.'''
+        return self.kind != "full"
+
+    @property
+    def accumulate(self):
+        return self.mode == "accumulate"
+
+    def apply_to(self, matrix):
+        '''Apply a delta message to a DataMatrix.
+
+        :returns: the changed region (see DataMatrix.apply_block)
+        '''
+        if self.kind == "block":
+            return matrix.apply_block(self.offset, self.data, self.accumulate)
+        elif self.kind == "sparse":
+            return matrix.apply_sparse(self.indices, self.data,
+                                       self.accumulate)
+        raise ValueError("Not a delta message.")
 
     @classmethod
     def from_dict(cls, a_dict):
@@ -17,9 +117,125 @@ class Message(object):
         return Message(a_dict.get("name", "data"), data)
 
     def as_dict(self):
+        if self.is_delta:
+            raise ValueError("Changes cannot be sent with protocol 1.")
         return {
             "name" : self.name,
             "shape" : self.shape,
             "dtype" : self.dtype,
             "data" : base64.b64encode(np.ascontiguousarray(self.data))
-        }
\ No newline at end of file
+        }
+
+    @classmethod
+    def from_frames(cls, frames):
+        '''Message from the frames of protocol 2.
+
+        :param frames: header and data as bytes-like objects
+            (the array will share memory with the data frame)
+        '''
+        header = json.loads(bytes(frames[0]).decode("utf-8"))
+        dtype = np.dtype(header["dtype"]).newbyteorder(header["byteorder"])
+        codec = header.get("codec")
+        if codec is not None and codec not in CODECS:
+            raise UnknownCodec("Unknown codec: " + str(codec))
+        count = int(np.prod(header["shape"]))
+        data = _frame_array(frames[1], dtype, codec, count)
+        data = data.reshape(header["shape"])
+        indices = None
+        if header.get("kind") == "sparse":
+            indices = _frame_array(frames[2], header["index_dtype"], codec,
+                                   count * 3)
+            indices = indices.reshape(-1, 3)
+        return Message(header.get("name", "data"), data,
+                       header.get("kind", "full"),
+                       header.get("mode", "replace"),
+                       header.get("offset"), indices)
+
+    def header(self):
+        '''JSON-serializable header of the protocol 2.'''
+        dtype = np.dtype(self.data.dtype)
+        header = {
+            "protocol" : PROTOCOL_VERSION,
+            "name" : self.name,
+            "shape" : list(self.shape),
+            "dtype" : dtype.str,
+            "byteorder" : dtype.byteorder if dtype.byteorder != "=" else
+                ("<" if np.little_endian else ">")
+        }
+        if self.is_delta:
+            header["kind"] = self.kind
+            header["mode"] = self.mode
+        if self.kind == "block":
+            header["offset"] = [int(i) for i in self.offset]
+        elif self.kind == "sparse":
+            header["index_dtype"] = np.dtype(self.indices.dtype).str
+        return header
+
+    def as_frames(self, compression=None, level=1,
+                  threshold=COMPRESSION_THRESHOLD):
+        '''Frames of the protocol 2: [header, data] (+ indices).
+
+        Without compression, the data frame is the array itself
+        (no copy for contiguous arrays).
+
+        :param compression: None or "zlib" (shuffled for multi-byte
+            elements)
+        :param level: zlib compression level (1-9)
+        :param threshold: arrays smaller than this (in bytes) are
+            sent uncompressed
+        '''
+        header = self.header()
+        arrays = [np.ascontiguousarray(self.data)]
+        if self.kind == "sparse":
+            arrays.append(np.ascontiguousarray(self.indices))
+        if compression not in (None, "zlib"):
+            raise ValueError("Unknown compression: " + str(compression))
+        if compression and sum(a.nbytes for a in arrays) >= threshold:
+            codec = "shuffle-zlib" if self.data.dtype.itemsize > 1 else "zlib"
+            compressed = [_compress(a, codec, level) for a in arrays]
+            # Not worth it for incompressible data
+            if sum(len(c) for c in compressed) < sum(a.nbytes for a in arrays):
+                header["codec"] = codec
+                arrays = compressed
+        return [json.dumps(header).encode("utf-8")] + arrays
+
+
+def _compress(array, codec, level):
+    '''Compressed bytes of a contiguous array.'''
+    data = array.reshape(-1).view(np.uint8)
+    if codec == "shuffle-zlib":
+        data = data.reshape(-1, array.dtype.itemsize).T
+    return zlib.compress(np.ascontiguousarray(data).tostring(), level)
+
+
+def _frame_array(frame, dtype, codec=None, count=None):
+    '''1D array with data of a frame.
+
+    Uncompressed data share memory with the frame, compressed data are
+    decompressed piece by piece into a preallocated array.
+    '''
+    dtype = np.dtype(dtype)
+    # asarray(memoryview) accepts any object with the buffer protocol
+    # (incl. zmq frames in Python 2), the result shares the memory
+    data = np.asarray(memoryview(frame)).reshape(-1).view(np.uint8)
+    if codec is None:
+        return data.view(dtype)
+
+    result = np.empty(count * dtype.itemsize, dtype=np.uint8)
+    decompressor = zlib.decompressobj()
+    chunks = (decompressor.decompress(data[start:start + _DECOMPRESS_CHUNK])
+              for start in range(0, len(data), _DECOMPRESS_CHUNK))
+    position = 0
+    for chunk in itertools.chain(chunks, [decompressor.flush()]):
+        if position + len(chunk) > len(result):
+            raise ValueError("Decompressed data too long.")
+        result[position:position + len(chunk)] = \
+            np.frombuffer(chunk, dtype=np.uint8)
+        position += len(chunk)
+    if position != len(result):
+        raise ValueError("Decompressed data too short.")
+    if codec == "shuffle-zlib":
+        shuffled = result.reshape(dtype.itemsize, -1)
+        result = np.empty_like(result)
+        result.reshape(-1, dtype.itemsize)[...] = shuffled.T
+    return result.view(dtype)
@@ -1,29 +1,197 @@
 import zmq
+import json
 import threading
-import time
+import collections
 
-from message import Message
+from message import Message, UnknownCodec, UNKNOWN_CODEC_REPLY
 
 DEFAULT_PORT = 9779
 
+class MessageQueue(object):
+    '''Bounded thread-safe queue of received messages.
+
+    Overflow policies:
+
+    * "drop_oldest" - when the queue is full, the oldest message
+      is thrown away
+
+    * "coalesce" - a new full message replaces waiting messages with
+      the same name (only the latest data of each name are kept);
+      if there is none and the queue is full, the oldest message
+      is thrown away
+
+    Delta messages (changes of a matrix) are never thrown away, since
+    the following ones would be applied to wrong data. Neither is a full
+    message followed by queued deltas of the same name (they are changes
+    of it). If there is nothing else to throw away, the new message
+    is rejected instead.
+
+    The messages can be taken by a waiting thread (get, see Handler)
+    or by someone told about them by notify (pop, e.g. a GUI thread:
+    the messages wait here, not in its event queue, so they are
+    coalesced while it is busy).
+    '''
+    OVERFLOW_POLICIES = ("drop_oldest", "coalesce")
+
+    def __init__(self, maxlen=16, overflow="drop_oldest", notify=None):
+        '''
+        :param notify: Callable without arguments called (in the putting
+            thread) after each accepted message.
+        '''
+        if overflow not in self.OVERFLOW_POLICIES:
+            raise ValueError("Unknown overflow policy: " + str(overflow))
+        self.maxlen = maxlen
+        self.overflow = overflow
+        self.notify = notify
+        self.dropped = 0
+        self._items = collections.deque()
+        self._condition = threading.Condition()
+        self._closed = False
+
+    def __len__(self):
+        return len(self._items)
+
+    def put(self, message):
+        '''Add a message to the queue.
+
+        :returns: False if the message was rejected (full queue)
+        '''
+        accepted = self._put(message)
+        if accepted and self.notify:
+            self.notify()
+        return accepted
+
+    def _put(self, message):
+        with self._condition:
+            if self.overflow == "coalesce" and not message.is_delta:
+                same = [i for i, item in enumerate(self._items)
+                        if item.name == message.name]
+                if same:
+                    # The new message takes the place of the first one
+                    self._items[same[0]] = message
+                    for i in reversed(same[1:]):
+                        del self._items[i]
+                    self.dropped += len(same)
+                    return True
+            if len(self._items) >= self.maxlen:
+                droppable = self._droppable()
+                if droppable is None:
+                    return False
+                del self._items[droppable]
+                self.dropped += 1
+            self._items.append(message)
+            self._condition.notify()
+            return True
+
+    def _droppable(self):
+        '''Index of the oldest message that can be thrown away (or None).'''
+        items = list(self._items)
+        for i, item in enumerate(items):
+            if item.is_delta:
+                continue
+            if not any(later.is_delta and later.name == item.name
+                       for later in items[i + 1:]):
+                return i
+        return None
+
+    def get(self, timeout=None):
+        '''Wait for a message.
+
+        :returns: the oldest message or None (timeout or closed queue)
+        '''
+        with self._condition:
+            if not self._items and not self._closed:
+                self._condition.wait(timeout)
+            if self._items:
+                return self._items.popleft()
+            return None
+
+    def pop(self):
+        '''The oldest message (IndexError if empty).'''
+        with self._condition:
+            return self._items.popleft()
+
+    def wake(self):
+        '''Wake up all waiting threads (get returns None).'''
+        with self._condition:
+            self._condition.notify_all()
+
+    def close(self):
+        '''Wake up all waiting threads, no more messages will come.'''
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    @property
+    def closed(self):
+        return self._closed
+
+
 class Server(object):
-    def __init__(self, port=DEFAULT_PORT):
+    '''Server receiving data from clients (see Client).
+
+    The receiving loop waits (zmq poller) both for the messages and for
+    a stop request, so stop() ends it immediately. Received messages are
+    put into a bounded MessageQueue.
+    '''
+    def __init__(self, port=DEFAULT_PORT, max_queue=16,
+                 overflow="drop_oldest", dtype=None, notify=None):
+        '''
+        :param max_queue: Maximum number of messages waiting in the queue.
+        :param overflow: What to do with a full queue (see MessageQueue).
+        :param notify: Called when a message is queued (see MessageQueue).
+        :param dtype: Type to which received full matrices are converted
+            (None = keep the type sent by the client).
+        '''
         self.port = port
+        self.dtype = dtype
         self.socket = None
-        self.messages = []
+        self.messages = MessageQueue(max_queue, overflow, notify)
         self.thread = None
-        self._running = False 
+        self._running = False
         self._stopped = False
+        self._context = None
+        self._control = None
+        self._control_address = "inproc://server-control-%d" % id(self)
+
+    def _receive(self):
+        frames = self.socket.recv_multipart(copy=False)
+        try:
+            if len(frames) == 1:
+                # Protocol 1 (JSON)
+                message = Message.from_dict(json.loads(frames[0].bytes))
+            else:
+                message = Message.from_frames(
+                    [frames[0].bytes] + [frame.buffer for frame in frames[1:]])
+            if self.dtype is not None and not message.is_delta:
+                message = message.astype(self.dtype)
+        except UnknownCodec:
+            self.socket.send(UNKNOWN_CODEC_REPLY)
+            return
+        except Exception as exc:
+            self.socket.send(("Error: %s" % exc).encode("utf-8"))
+            return
+        if self.messages.put(message):
+            self.socket.send(b"Ok")
+        else:
+            self.socket.send(b"Error: Queue full.")
 
     def _run(self):
-        context = zmq.Context()
-        self.socket = context.socket(zmq.REP)
-        self.socket.bind("tcp://127.0.0.1:%s" % self.port)
-        while not self._stopped:
-            message_raw = self.socket.recv_json()
-            message = Message.from_dict(message_raw)
-            self.messages.append(message)
-            self.socket.send("Ok")       
+        poller = zmq.Poller()
+        poller.register(self.socket, zmq.POLLIN)
+        poller.register(self._control, zmq.POLLIN)
+        try:
+            while True:
+                events = dict(poller.poll())
+                if self._control in events:
+                    break
+                if self.socket in events:
+                    self._receive()
+        finally:
+            self.socket.close(linger=0)
+            self._control.close(linger=0)
+            self._running = False
+            self.messages.close()
 
     def start(self, new_thread=True, daemon=True):
         '''Start listening.
@@ -33,8 +201,14 @@ class Server(object):
         '''
         if self._running:
             raise Exception("Already running.")
-        elif self._stopped: 
+        elif self._stopped:
             raise Exception("Cannot restart an already stopped server.")
+        self._context = zmq.Context()
+        self.socket = self._context.socket(zmq.REP)
+        self.socket.bind("tcp://127.0.0.1:%s" % self.port)
+        self._control = self._context.socket(zmq.PAIR)
+        self._control.bind(self._control_address)
+        self._running = True
         if new_thread:
             self.thread = threading.Thread(target=self._run)
             self.thread.daemon = daemon
@@ -43,10 +217,18 @@ class Server(object):
             self._run()
 
     def stop(self):
-        self.socket.unbind()
+        '''Stop listening (and wait for the receiving loop to end).'''
+        if self._running:
+            control = self._context.socket(zmq.PAIR)
+            control.connect(self._control_address)
+            control.send(b"stop")
+            control.close()
         if self.thread:
             self.thread.join()
             self.thread = None
+        if self._context is not None:
+            self._context.term()
+            self._context = None
         self._stopped = True
         self._running = False
 
@@ -62,34 +244,38 @@ class Server(object):
         return len(self.messages) > 0
 
     def pop_message(self):
-        return self.messages.pop(0)
+        return self.messages.pop()
 
 class Handler(object):
-    '''
+    '''Calls a function for each message received by a server.
 
-
-    The polling will automatically end when the server stops.
+    The function is called in the handler thread as soon as a message
+    arrives. The thread ends when the server stops.
     '''
-    def __init__(self, server, handler, polling=0.5):
+    def __init__(self, server, handler, delta_handler=None):
         '''
 
-        :param polling: How many seconds to wait between polls.
         :param handler: A callable object that accepts two parameters: str and numpy.ndarray
+        :param delta_handler: A callable object that accepts the delta
+            messages (see Message.apply_to), they are ignored if not set
         '''
         self.server = server
         self.thread = None
         self.handler = handler
-        self.polling = polling
+        self.delta_handler = delta_handler
         self._stopped = False
 
     def _run(self):
         while not self._stopped:
-            if self.server.has_message():
-                message = self.server.pop_message()
+            message = self.server.messages.get()
+            if message is None:
+                if self.server.messages.closed:
+                    break
+            elif not message.is_delta:
                 self.handler(message.name, message.data)
-            if self.server.stopped:
-                self.stop()
-            time.sleep(self.polling)
+            elif self.delta_handler:
+                self.delta_handler(message)
+        self.thread = None
 
     def start(self):
         self.thread = threading.Thread(target=self._run)
@@ -97,8 +283,8 @@ class Handler(object):
         self.thread.start()
 
     def stop(self):
-        self._stopped = False
-        self.thread = None
+        self._stopped = True
+        self.server.messages.wake()
 
 if __name__ == "__main__":
     def log_message(name, data):
@@ -110,4 +296,3 @@ if __name__ == "__main__":
     handler = Handler(server, log_message)
     handler.start()
     server.start(False)  # Start in main thread
-    
\ No newline at end of file
@@ -7,9 +7,14 @@
 #
 # This file may be distributed without limitation.
 #
+import os
+
 from PyQt4 import QtGui, QtCore
+import numpy
 
-from data_matrix import DataMatrix, DataMatrixLoader, HDF5_ENABLED
+from data_matrix import (DataMatrix, DataMatrixLoader, LoadCancelled,
+                         ScoringFileTail, ReloadNeeded, HDF5_ENABLED)
+from cache import SidecarCache
 
 if HDF5_ENABLED:
     from h5_dialog import H5Dialog
@@ -17,12 +22,114 @@ if HDF5_ENABLED:
 
 from table_tab import TableTab
 from source_tab import SourceTab
+from line_index import LineIndex
 import net
 
 
+class MessageBridge(QtCore.QObject):
+    """ Tells the GUI thread that the server has queued messages.
+
+    It is called by the server thread (see net.MessageQueue notify),
+    the connected slots are invoked in the thread of the receiver
+    (queued connection). At most one signal waits in the event queue,
+    the messages stay in the bounded queue of the server (where they
+    are coalesced) until the receiver takes them.
+    """
+    available = QtCore.pyqtSignal()
+
+    def __init__(self, parent=None):
+        QtCore.QObject.__init__(self, parent)
+        self._pending = False
+
+    def __call__(self):
+        if not self._pending:
+            self._pending = True
+            self.available.emit()
+
+    def taken(self):
+        """ Called by the receiver before taking the messages."""
+        self._pending = False
+
+
+class LoadWorker(QtCore.QThread):
+    """ Thread loading a file outside of the GUI thread.
+
+    Text files are read once, the blocks are both parsed and indexed
+    for the source view (see LineIndex). The maximum is computed
+    in the thread as well (all views need it), HDF5 datasets are read
+    for it with progress and can be cancelled.
+    """
+    progress = QtCore.pyqtSignal(object, object)        # bytes read, total
+    # (request number, file name, path), matrix, LineIndex, error
+    loaded = QtCore.pyqtSignal(object, object, object, object)
+
+    def __init__(self, parent=None):
+        QtCore.QThread.__init__(self, parent)
+        self.file_name = None
+        self.path = None     # HDF5 dataset, None for text files
+        self.watching = False
+        self.request = 0     # Identifies results of the current load
+        self._cancelled = False
+
+    def load(self, file_name, path=None, watching=False):
+        """ Start loading.
+
+        :param watching: load text files to be followed, i.e. as dense
+            matrices which can be updated in place, accepting files
+            which are still being written
+        """
+        self.file_name = file_name
+        self.path = path
+        self.watching = watching
+        self.request += 1
+        self._cancelled = False
+        self.start()
+
+    def cancel(self):
+        self._cancelled = True
+
+    def _progress(self, done, total):
+        if self._cancelled:
+            raise LoadCancelled()
+        self.progress.emit(done, total)
+
+    def run(self):
+        matrix, source, error = None, None, None
+        try:
+            if self.path is None:
+                source = LineIndex(self.file_name)
+                matrix = DataMatrixLoader.from_csv(
+                    self.file_name, progress=self._progress, source=source,
+                    writable=self.watching, partial=self.watching)
+                if source.empty:
+                    # Taken from the cache
+                    source.build()
+                else:
+                    source.finish()
+                matrix.max_value
+            else:
+                matrix = DataMatrixLoader.from_hdf5(self.file_name, self.path)
+                # The whole dataset is read (with progress, cancellable)
+                matrix.compute_max_value(self._progress)
+            if self._cancelled:
+                raise LoadCancelled()
+        except Exception as exc:
+            if matrix is not None:
+                matrix.close()
+            if source is not None:
+                source.close()
+            matrix, source, error = None, None, exc
+        self.loaded.emit((self.request, self.file_name, self.path),
+                         matrix, source, error)
+
+
 class ApplicationWindow(QtGui.QMainWindow):
+    # Minimum time between updates of a watched file (ms)
+    WATCH_INTERVAL = 1000
+
     def __init__(self):
         QtGui.QMainWindow.__init__(self)
+        DataMatrixLoader.cache = SidecarCache()
         self.build_menu()
 
         self.tabs = QtGui.QTabWidget(self)
@@ -48,6 +155,29 @@ class ApplicationWindow(QtGui.QMainWindow):
         self.setCentralWidget(self.tabs)
         self.setWindowTitle("Scoring Output Browser")
 
+        self.memory_label = QtGui.QLabel()
+        self.statusBar().addPermanentWidget(self.memory_label)
+        # Pyramid levels etc. are built lazily by the views
+        self.memory_timer = QtCore.QTimer(self)
+        self.memory_timer.timeout.connect(self.update_memory_label)
+        self.memory_timer.start(2000)
+
+        self.load_worker = LoadWorker(self)
+        self.load_worker.progress.connect(self.on_load_progress)
+        self.load_worker.loaded.connect(self.on_file_loaded)
+        self.progress_dialog = None
+
+        # Watching of the file for appended data (see follow_file)
+        self.watcher = QtCore.QFileSystemWatcher(self)
+        self.watcher.fileChanged.connect(self.on_file_changed)
+        self.watch_timer = QtCore.QTimer(self)
+        self.watch_timer.setSingleShot(True)
+        self.watch_timer.setInterval(self.WATCH_INTERVAL)
+        self.watch_timer.timeout.connect(self.follow_file)
+        self.watched_file = None
+        self.tail = None
+        self.loaded_size = None
+
         self.set_status("Ready")
         self.restore_settings()
 
@@ -55,20 +185,40 @@ class ApplicationWindow(QtGui.QMainWindow):
         self.file_menu = QtGui.QMenu('&File', self)
         self.file_menu.addAction('&Open', self.open_file,
                                  QtCore.Qt.CTRL + QtCore.Qt.Key_O)
+        self.file_menu.addAction('&Merge Files...', self.merge_files)
         self.reload_action = self.file_menu.addAction('&Reload', lambda: self.reload_file(),
             QtCore.Qt.Key_F5)
         self.reload_action.setEnabled(False)
+        self.watch_action = self.file_menu.addAction('&Watch File')
+        self.watch_action.setCheckable(True)
+        self.watch_action.setEnabled(False)
+        self.watch_action.toggled.connect(self.set_watching)
 
         self.csv_action = self.file_menu.addAction('E&xport Table as CSV',
                                  self.export_csv,
                                  QtCore.Qt.CTRL + QtCore.Qt.Key_X)
         self.csv_action.setEnabled(False)
+        self.html_action = self.file_menu.addAction('Export Table as &HTML',
+                                 self.export_html)
+        self.html_action.setEnabled(False)
         self.file_menu.addAction('&Quit', self.close,
                                  QtCore.Qt.CTRL + QtCore.Qt.Key_Q)        
 
         self.menuBar().addMenu(self.file_menu)
 
         self.options_menu = QtGui.QMenu("&Options", self)
+        self.options_menu.addAction("C&lear File Cache", self.clear_cache)
+        precision_menu = self.options_menu.addMenu("&Precision")
+        precision_group = QtGui.QActionGroup(self)
+        for dtype, text in (("float64", "Double (float64)"),
+                            ("float32", "Single (float32)"),
+                            ("float16", "Half (float16)")):
+            action = precision_menu.addAction(text)
+            action.setCheckable(True)
+            action.setChecked(numpy.dtype(dtype) == DataMatrixLoader.dtype)
+            action.triggered.connect(
+                lambda checked, dtype=dtype: self.set_precision(dtype))
+            precision_group.addAction(action)
         self.menuBar().addMenu(self.options_menu)
 
         self.tools_menu = QtGui.QMenu('&Tools', self)
@@ -79,13 +229,30 @@ class ApplicationWindow(QtGui.QMainWindow):
         self.start_server_action.setCheckable(True)
         self.menuBar().addMenu(self.tools_menu)
 
+    def set_precision(self, dtype):
+        """ Type of values of newly loaded (or received) matrices."""
+        DataMatrixLoader.dtype = numpy.dtype(dtype)
+        if hasattr(self, "server"):
+            self.server.dtype = DataMatrixLoader.dtype
+        self.set_status("New data will be stored as %s." % dtype)
+
+    def update_memory_label(self):
+        matrix = getattr(self, "matrix", None)
+        if matrix is None:
+            self.memory_label.setText("")
+        else:
+            self.memory_label.setText(
+                "%s, %.1f MB" % (matrix.dtype, matrix.memory_usage / 1e6))
+
     def set_matrix(self, matrix):
+        old_matrix = getattr(self, "matrix", None)
         self.matrix = matrix
-        self.tableTab.matrix = matrix
-        if hasattr(self, "chartTab"):
-            self.chartTab.matrix = matrix
-        if hasattr(self, "histogramTab"):
-            self.histogramTab.matrix = matrix
+        for tab in self.slice_tabs:
+            tab.matrix = matrix
+        self.update_memory_label()
+        if (old_matrix is not None and old_matrix is not matrix and
+                old_matrix not in getattr(self, "live_matrices", {}).values()):
+            old_matrix.close()
 
     def show_reduction_dialog(self):
         dialog = QtGui.QDialog(self)
@@ -107,12 +274,27 @@ class ApplicationWindow(QtGui.QMainWindow):
         layout.addWidget(QtGui.QLabel("Reduction in Z Axis"))
         layout.addWidget(ztext)
 
+        method_combo = QtGui.QComboBox()
+        for method in ("sum", "mean", "max", "min",
+                       "nansum", "nanmean", "nanmax", "nanmin"):
+            method_combo.addItem(method)
+        layout.addWidget(QtGui.QLabel("Aggregation"))
+        layout.addWidget(method_combo)
+
+        edges_combo = QtGui.QComboBox()
+        for edges in ("strict", "pad", "truncate"):
+            edges_combo.addItem(edges)
+        layout.addWidget(QtGui.QLabel("Incomplete boxes at the edges"))
+        layout.addWidget(edges_combo)
+
         def onButtonClick():
             try:
                 x = int(xtext.text())
                 y = int(ytext.text())
                 z = int(ztext.text())
-                matrix = self.matrix.reduced((x, y, z))
+                matrix = self.matrix.reduced((x, y, z),
+                                             str(method_combo.currentText()),
+                                             str(edges_combo.currentText()))
                 self.set_matrix(matrix)
                 dialog.close()
             except ValueError:
@@ -124,7 +306,6 @@ class ApplicationWindow(QtGui.QMainWindow):
         layout.addWidget(button)
 
         dialog.show()
-        self.set_matrix(self.matrix.copy())  # ???
 
     def open_file(self):
         """ Invoke file open dialog and read the selected file."""
@@ -146,61 +327,315 @@ class ApplicationWindow(QtGui.QMainWindow):
         """
         raise Exception("Reload called while impossible.")
 
+    def set_watching(self, watching):
+        """ Start (or stop) following changes of the loaded text file."""
+        if self.watcher.files():
+            self.watcher.removePaths(self.watcher.files())
+        self.watch_timer.stop()
+        self.tail = None
+        if watching and self.watched_file:
+            self.watcher.addPath(self.watched_file)
+            if getattr(self, "matrix", None) is not None:
+                # Appended data are written into the matrix
+                matrix = DataMatrixLoader.writable(self.matrix)
+                if matrix is not self.matrix:
+                    self.set_matrix(matrix)
+                try:
+                    self.tail = ScoringFileTail(self.watched_file,
+                                                self.loaded_size)
+                except IOError:
+                    pass
+
+    def stop_watching(self):
+        self.watch_action.setChecked(False)
+        self.watch_action.setEnabled(False)
+
+    def on_file_changed(self, file_name):
+        # At most one update per WATCH_INTERVAL
+        if not self.watch_timer.isActive():
+            self.watch_timer.start()
+
+    def follow_file(self):
+        """ Apply the data appended to the watched file.
+
+        Only the new lines are parsed (see ScoringFileTail), the file
+        is loaded again if it was rewritten.
+        """
+        if self.load_worker.isRunning():
+            self.watch_timer.start()
+            return
+        if (not self.watcher.files() and
+                os.path.exists(self.watched_file)):
+            # Some programs replace the file instead of writing into it
+            self.watcher.addPath(self.watched_file)
+        if self.tail is None:
+            # The last loading failed (e.g. there were no data yet)
+            self.reload_file()
+            return
+        max_value = self.matrix.max_value
+        shape = self.matrix.shape
+        try:
+            region = self.tail.update(self.matrix)
+        except ReloadNeeded:
+            self.reload_file()
+            return
+        except Exception as exc:
+            self.set_status("Error reading appended data: %s" % exc)
+            return
+        if self.matrix.shape != shape:
+            # The file is still being written, the matrix grew
+            for tab in self.slice_tabs:
+                tab.matrix_changed.emit()
+            self.update_memory_label()
+        elif region is not None:
+            self.notify_data_changed(region, max_value)
+        if region is not None:
+            self.sourceTab.refresh()
+            self.set_status("File updated.")
+
+    def notify_data_changed(self, region, max_value):
+        """ Update the views of the changed region of the matrix.
+
+        :param max_value: the maximum before the change
+        """
+        if self.matrix.max_value != max_value:
+            region = None   # All colours / relative values changed
+        for tab in self.slice_tabs:
+            tab.notify_data_changed(region)
+        self.update_memory_label()
+
     def export_csv(self):
         """ Export current displayed table as CSV."""
         file_name = QtGui.QFileDialog.getSaveFileName(self, "Select CSV File")
         if file_name:
             self.tableTab.write_csv(file_name)
 
-    def read_file_csv(self, file_name):
+    def export_html(self):
+        """ Export current displayed table as HTML (with colours)."""
+        file_name = QtGui.QFileDialog.getSaveFileName(self, "Select HTML File")
+        if file_name:
+            self.tableTab.write_html(file_name)
+
+    def show_error(self, text):
+        msgBox = QtGui.QMessageBox()
+        msgBox.setWindowTitle("Application Error")
+        msgBox.setText(text)
+        msgBox.exec_()
+
+    def load_file(self, file_name, path=None):
+        """ Start loading a file in the background (see LoadWorker).
+
+        A load in progress is cancelled first.
+        """
+        if self.load_worker.isRunning():
+            self.load_worker.cancel()
+            self.load_worker.wait()
+        self.close_progress_dialog()
         self.set_status("Opening " + file_name + "...")
-        try:
-            matrix = DataMatrixLoader.from_csv(file_name)
-            with open(file_name) as f:
-                text = f.read()
-                self.sourceTab.setText(text)
+        # Steps of 0.1 % (the byte counts do not fit into int)
+        self.progress_dialog = QtGui.QProgressDialog(
+            "Loading " + file_name + "...", "Cancel", 0, 1000, self)
+        self.progress_dialog.setWindowModality(QtCore.Qt.WindowModal)
+        self.progress_dialog.setMinimumDuration(500)
+        self.progress_dialog.canceled.connect(self.load_worker.cancel)
+        self.load_worker.load(file_name, path,
+                              self.watch_action.isChecked())
+
+    def close_progress_dialog(self):
+        """ Close the dialog of the current load (if any).
+
+        It is disconnected first, closing the dialog emits canceled.
+        """
+        if self.progress_dialog:
+            self.progress_dialog.canceled.disconnect(self.load_worker.cancel)
+            self.progress_dialog.close()
+            self.progress_dialog = None
+
+    def on_load_progress(self, done, total):
+        if self.progress_dialog and total:
+            self.progress_dialog.setValue(int(1000 * done / total))
+
+    def on_file_loaded(self, request, matrix, source, error):
+        request, file_name, path = request
+        if request != self.load_worker.request:
+            # Cancelled by another load
+            if matrix is not None:
+                matrix.close()
+            if source is not None:
+                source.close()
+            return
+        self.close_progress_dialog()
+        if isinstance(error, LoadCancelled):
+            self.set_status("Loading cancelled.")
+            return
+        elif (error is not None and path is None and
+                file_name == self.watched_file and
+                self.watch_action.isChecked()):
+            # Reload of a watched file, tried again with its next change
+            self.set_status("Error reading watched file: %s" % error)
+            return
+        elif error is not None:
+            self.show_error(str(error))
+            self.set_status("Error reading file.")
+        else:
             self.file_name = file_name
             self.set_status("Successfully read " + file_name)
             self.setWindowTitle("Scoring Output Browser (" + file_name + ")")
+        if source is not None:
+            self.sourceTab.set_source(source, matrix.shape)
+            self.loaded_size = source.size
+        elif path is None:
+            self.sourceTab.setText("")
+        self.set_matrix(matrix)
+        if path is None:
+            self.watched_file = file_name
+            self.watch_action.setEnabled(True)
+            self.set_watching(self.watch_action.isChecked())
+        else:
+            self.stop_watching()
+        self.reload_action.setEnabled(True)
+        self.csv_action.setEnabled(path is None)
+        self.html_action.setEnabled(path is None)
+        self.reload_file = lambda: self.load_file(file_name, path)
+
+    def read_file_csv(self, file_name):
+        self.load_file(file_name)
+
+    def merge_files(self):
+        """ Invoke file dialog and sum the selected files."""
+        file_names = QtGui.QFileDialog.getOpenFileNames(
+            self, "Select Data Files to Merge")
+        file_names = [str(file_name) for file_name in file_names]
+        if not file_names:
+            return
+        text, ok = QtGui.QInputDialog.getText(
+            self, "Merge Files",
+            "Numbers of primaries (space-separated, empty = plain sum):")
+        if not ok:
+            return
+        try:
+            primaries = [float(n) for n in str(text).split()] or None
+        except ValueError:
+            self.show_error("Invalid numbers of primaries: " + str(text))
+            return
+        self.read_files_merged(file_names, primaries)
+
+    def read_files_merged(self, file_names, primaries=None):
+        self.set_status("Merging %d files..." % len(file_names))
+        progress_dialog = QtGui.QProgressDialog(
+            "Merging files...", QtCore.QString(), 0, len(file_names), self)
+        progress_dialog.setWindowModality(QtCore.Qt.WindowModal)
+
+        def progress(done, total):
+            progress_dialog.setValue(done)
+            QtGui.QApplication.processEvents()
+
+        try:
+            matrix = DataMatrixLoader.merge(file_names, primaries=primaries,
+                                            progress=progress)
+            self.sourceTab.setText("Merged files:\n" + "\n".join(file_names))
+            self.set_status("Successfully merged %d files." % len(file_names))
+            self.setWindowTitle("Scoring Output Browser (%d merged files)"
+                                % len(file_names))
         except Exception as exc:
             matrix = None
-            msgBox = QtGui.QMessageBox()
-            msgBox.setWindowTitle("Application Error")
-            msgBox.setText(str(exc))
-            msgBox.exec_()
-            self.set_status("Error reading file.")
-        self.set_matrix(matrix)  # ?
+            self.show_error(str(exc))
+            self.set_status("Error merging files.")
+        progress_dialog.close()
+        self.stop_watching()
+        self.set_matrix(matrix)
         self.reload_action.setEnabled(True)
         self.csv_action.setEnabled(True)
-        self.reload_file = lambda: self.read_file_csv(file_name)
+        self.html_action.setEnabled(True)
+        self.reload_file = lambda: self.read_files_merged(file_names,
+                                                          primaries)
 
     def read_file_hdf5(self, file_name, path):
-        self.csv_action.setEnabled(False)
-        matrix = DataMatrixLoader.from_hdf5(file_name, path)
-        self.set_matrix(matrix)
-        self.reload_action.setEnabled(True)
-        self.reload_file = lambda: self.read_file_hdf5(file_name, path)
+        self.load_file(file_name, path)
+
+    def clear_cache(self):
+        """ Remove all binary copies of parsed files."""
+        if DataMatrixLoader.cache:
+            DataMatrixLoader.cache.clear()
+            self.set_status("File cache cleared.")
 
     def set_status(self, text):
         """ Display a status message."""
         self.statusBar().showMessage(text)
 
+    @property
+    def slice_tabs(self):
+        tabs = [self.tableTab]
+        for name in ("chartTab", "histogramTab"):
+            if hasattr(self, name):
+                tabs.append(getattr(self, name))
+        return tabs
+
+    def on_messages_available(self):
+        """ Process the messages queued by the server (in the GUI thread).
+
+        Only those waiting now are taken, the ones arriving meanwhile
+        signal again (the event loop is not blocked by a busy client).
+        """
+        self.message_bridge.taken()
+        for i in range(len(self.server.messages)):
+            if not self.server.has_message():
+                break
+            message = self.server.pop_message()
+            if message.is_delta:
+                self.on_delta_received(message)
+            else:
+                self.on_data_received(message.name, message.data)
+
+    def on_data_received(self, name, data):
+        """ Display data sent by a client (called in the GUI thread)."""
+        matrix = DataMatrix(data, name)
+        # Kept for the following changes sent by the client
+        self.live_matrices[name] = matrix
+        self.reload_action.setEnabled(False)
+        self.stop_watching()
+        self.set_status("New data arrived from a client.")
+        self.setWindowTitle("Scoring Output Browser: %s" % name)
+        self.set_matrix(matrix)
+
+    def on_delta_received(self, message):
+        """ Apply a change of data sent by a client (in the GUI thread).
+
+        Only the views of the changed slices are updated.
+        """
+        matrix = self.live_matrices.get(message.name)
+        if matrix is None:
+            self.set_status("Change of unknown data '%s' ignored."
+                            % message.name)
+            return
+        max_value = matrix.max_value
+        try:
+            region = message.apply_to(matrix)
+        except ValueError as exc:
+            self.set_status("Invalid change of '%s': %s" % (message.name, exc))
+            return
+        if matrix is self.matrix:
+            self.notify_data_changed(region, max_value)
+
     def start_server(self):
-        def handler_method(name, data):
-            matrix = DataMatrix(data, name)
-            self.reload_action.setEnabled(False)
-            self.set_status("New data arrived from a client.")
-            self.setWindowTitle("Scoring Output Browser: %s" % name)
-            self.set_matrix(matrix)
-
-        server = net.Server()
-        handler = net.Handler(server, handler_method)
-        server.start()
-        handler.start()
+        self.live_matrices = {}
+        self.message_bridge = MessageBridge(self)
+        self.message_bridge.available.connect(self.on_messages_available)
+
+        # Only the latest data of each name are worth displaying
+        self.server = net.Server(overflow="coalesce",
+                                 dtype=DataMatrixLoader.dtype,
+                                 notify=self.message_bridge)
+        self.server.start()
         self.start_server_action.setChecked(True)
         self.start_server_action.setEnabled(False)
 
     def closeEvent(self, event):
+        if self.load_worker.isRunning():
+            self.load_worker.cancel()
+            self.load_worker.wait()
+        if hasattr(self, "server"):
+            self.server.stop()
         settings = QtCore.QSettings()
         settings.setValue("window/geometry", self.saveGeometry())
         settings.setValue("window/state", self.saveState())
@@ -0,0 +1,65 @@
+#
+# scoring_browser --- Simple Qt application for browsing
+# scoring outputs in Geant4
+#
+# Copyright (C) 2012-2014 Jan Pipek
+# (jan.pipek@gmail.com)
+#
+# This file may be distributed without limitation.
+#
+import math
+import numpy
+
+
+class RunningStatistics(object):
+    """Summary statistics of values added in blocks (numpy arrays).
+
+    Each block is summarized by numpy and merged into the result using
+    the parallel variance formula (Chan et al.), so the values themselves
+    are never kept and the variance is numerically stable.
+
+    NaN's are not included in the statistics, only counted.
+    """
+    def __init__(self):
+        self.count = 0
+        self.nan_count = 0
+        self.total = 0.0
+        self.mean = 0.0
+        self.m2 = 0.0    # Sum of squared deviations from the mean
+        self.minimum = numpy.nan
+        self.maximum = numpy.nan
+
+    def add(self, block):
+        """Include all values of an array."""
+        block = numpy.asarray(block, dtype=float)
+        nan = numpy.isnan(block)
+        if nan.any():
+            self.nan_count += int(nan.sum())
+            block = block[~nan]
+        n = block.size
+        if not n:
+            return
+
+        total = block.sum()
+        mean = total / n
+        m2 = numpy.square(block - mean).sum()
+
+        count = self.count + n
+        delta = mean - self.mean
+        self.mean += delta * n / count
+        self.m2 += m2 + delta ** 2 * self.count * n / count
+        self.count = count
+        self.total += total
+        self.minimum = numpy.nanmin((self.minimum, block.min()))
+        self.maximum = numpy.nanmax((self.maximum, block.max()))
+
+    @property
+    def variance(self):
+        """Sample variance (NaN for less than two values)."""
+        if self.count < 2:
+            return numpy.nan
+        return self.m2 / (self.count - 1)
+
+    @property
+    def stddev(self):
+        return math.sqrt(self.variance)
@@ -17,6 +17,11 @@ class SliceTab(QtGui.QWidget):
     slice_index_changed = QtCore.pyqtSignal(name='sliceIndexChanged')
     relative_changed = QtCore.pyqtSignal(name='relativeChanged')
 
+    # Values of the matrix changed in place (the argument is the changed
+    # region or None), the second one only if the current slice changed
+    data_changed = QtCore.pyqtSignal(object, name='dataChanged')
+    slice_data_changed = QtCore.pyqtSignal(name='sliceDataChanged')
+
     def __init__(self, parent):
         # Initialize
         self.parent = parent
@@ -28,6 +33,10 @@ class SliceTab(QtGui.QWidget):
         self._plane = "xy"
         self._relative = False
 
+        # Displayed part of the slice ((min, max) for both axes
+        # in full-resolution indices), None = whole slice
+        self.view_region = None
+
         self.initialize_ui()
 
     @property
@@ -92,6 +101,8 @@ class SliceTab(QtGui.QWidget):
 
         for signal in self.all_model_signals:
             signal.connect(self.update_slider)
+        self.matrix_changed.connect(self.reset_view_region)
+        self.plane_changed.connect(self.reset_view_region)
 
     @property
     def matrix(self):
@@ -149,6 +160,68 @@ class SliceTab(QtGui.QWidget):
     def slice(self):
         return DataMatrixSlice2D(self.matrix, self.plane, self.slice_index)
 
+    def slice_affected(self, region):
+        """Whether the region ((x0, x1), (y0, y1), (z0, z1)) intersects
+        the current slice (None = whole matrix)."""
+        if region is None:
+            return True
+        low, high = region[self.slice.axis]
+        return low <= self.slice_index < high
+
+    def notify_data_changed(self, region=None):
+        """Tell the tab that values of its matrix were changed in place."""
+        if not self.matrix:
+            return
+        self.data_changed.emit(region)
+        if self.slice_affected(region):
+            self.slice_data_changed.emit()
+
+    def reset_view_region(self):
+        self.view_region = None
+
+    def max_display_shape(self):
+        """Largest slice shape worth displaying at once.
+
+        None means that the full resolution is always used.
+        """
+        return None
+
+    def display_level(self):
+        """Coarsest pyramid level at which the viewed region fits the widget.
+        """
+        max_shape = self.max_display_shape()
+        if not self.matrix or not max_shape:
+            return 0
+        if self.view_region:
+            extent = [high - low for low, high in self.view_region]
+        else:
+            extent = self.slice.shape
+        level = 0
+        while (level + 1 < self.matrix.level_count and
+               any(size > max_size * 2 ** level
+                   for size, max_size in zip(extent, max_shape))):
+            level += 1
+        return level
+
+    def display_data(self, level=0):
+        """Slice data at a pyramid level, limited to the view_region.
+
+        :returns: (data, origin), origin being the full-resolution index
+        of the first element
+        """
+        scale = 2 ** level
+        data = DataMatrixSlice2D(self.matrix.level(level), self.slice.axis,
+                                 self.slice_index // scale).data
+        origin = (0, 0)
+        if self.view_region:
+            (low0, high0), (low1, high1) = self.view_region
+            start0 = max(0, int(low0) // scale - 1)
+            start1 = max(0, int(low1) // scale - 1)
+            data = data[start0:int(high0) // scale + 2,
+                        start1:int(high1) // scale + 2]
+            origin = (start0 * scale, start1 * scale)
+        return data, origin
+
     def on_slider_value_changed(self, value):
         self.slice_index = value
 
@@ -7,17 +7,174 @@
 #
 # This file may be distributed without limitation.
 #
-from PyQt4 import QtGui
+import collections
+
+from PyQt4 import QtGui, QtCore
+
+from line_index import TextLines
+
+
+class SourceModel(QtCore.QAbstractListModel):
+    """ Lines of a LineIndex (or TextLines) for a list view.
+
+    The view asks only for the visible lines, they are read from the file
+    in pages of PAGE_SIZE lines and a few recent pages are kept.
+    """
+    PAGE_SIZE = 256
+
+    MAX_PAGES = 16
+
+    def __init__(self, parent=None):
+        QtCore.QAbstractListModel.__init__(self, parent)
+        self.lines = TextLines("")
+        self.count = 0
+        self._pages = collections.OrderedDict()
+
+    def set_lines(self, lines):
+        self.beginResetModel()
+        self.lines.close()
+        self.lines = lines
+        self.count = lines.line_count
+        self._pages.clear()
+        self.endResetModel()
+
+    def refresh(self):
+        """ Show lines appended to the file (see LineIndex.refresh)."""
+        self.lines.refresh()
+        self._pages.clear()
+        old_count, new_count = self.count, self.lines.line_count
+        if new_count > old_count:
+            self.beginInsertRows(QtCore.QModelIndex(), old_count,
+                                 new_count - 1)
+            self.count = new_count
+            self.endInsertRows()
+        if old_count:
+            # The last line could have been unfinished
+            index = self.index(old_count - 1)
+            self.dataChanged.emit(index, index)
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+        return self.count
+
+    def line(self, row):
+        page = row // self.PAGE_SIZE
+        if page not in self._pages:
+            if len(self._pages) >= self.MAX_PAGES:
+                self._pages.popitem(last=False)
+            self._pages[page] = self.lines.lines(page * self.PAGE_SIZE,
+                                                 self.PAGE_SIZE)
+        return self._pages[page][row % self.PAGE_SIZE]
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if role == QtCore.Qt.DisplayRole and index.isValid():
+            return QtCore.QVariant(self.line(index.row()))
+        return QtCore.QVariant()
 
 
 class SourceTab(QtGui.QWidget):
-    """ Tab displaying the file source."""
+    """ Tab displaying the file source.
+
+    Files are not read into memory, see LineIndex.
+    """
     def __init__(self):
         QtGui.QWidget.__init__(self)
+        self.shape = None
         layout = QtGui.QVBoxLayout(self)
-        self.textEdit = QtGui.QTextEdit()
-        self.textEdit.setReadOnly(True)
-        layout.addWidget(self.textEdit)
+        layout.addLayout(self.build_toolbar())
+
+        self.model = SourceModel(self)
+        self.listView = QtGui.QListView()
+        self.listView.setModel(self.model)
+        # Row heights are not computed for all lines
+        self.listView.setUniformItemSizes(True)
+        self.listView.setFont(QtGui.QFont("Monospace"))
+        layout.addWidget(self.listView)
+
+    def build_toolbar(self):
+        toolbar = QtGui.QHBoxLayout()
+
+        toolbar.addWidget(QtGui.QLabel("Voxel (x y z):"))
+        self.voxelEdit = QtGui.QLineEdit()
+        self.voxelEdit.returnPressed.connect(self.jump_to_voxel)
+        toolbar.addWidget(self.voxelEdit)
+        button = QtGui.QPushButton("Go")
+        button.clicked.connect(self.jump_to_voxel)
+        toolbar.addWidget(button)
+
+        toolbar.addWidget(QtGui.QLabel("Find:"))
+        self.findEdit = QtGui.QLineEdit()
+        self.findEdit.returnPressed.connect(self.find_next)
+        toolbar.addWidget(self.findEdit)
+        button = QtGui.QPushButton("Next")
+        button.clicked.connect(self.find_next)
+        toolbar.addWidget(button)
+        return toolbar
+
+    def set_source(self, line_index, shape=None):
+        """ Display a file (the previous one is closed).
+
+        :param line_index: LineIndex of the file
+        :param shape: shape of the matrix (for jumping to voxels)
+        """
+        self.shape = shape
+        self.model.set_lines(line_index)
 
     def setText(self, text):
-        self.textEdit.setText(text)
+        self.shape = None
+        self.model.set_lines(TextLines(text))
+
+    def refresh(self):
+        """ Show lines appended to the displayed file."""
+        if hasattr(self.model.lines, "refresh"):
+            self.model.refresh()
+
+    def go_to_line(self, line):
+        index = self.model.index(line)
+        self.listView.setCurrentIndex(index)
+        self.listView.scrollTo(index, QtGui.QAbstractItemView.PositionAtCenter)
+
+    def jump_to_voxel(self):
+        try:
+            voxel = [int(i) for i in str(self.voxelEdit.text()).split()]
+            if len(voxel) != 3 or not self.shape:
+                raise ValueError()
+            line = self.model.lines.voxel_line(voxel, self.shape)
+        except ValueError:
+            line = None
+        if line is None:
+            QtGui.QMessageBox.information(self, "Source", "Voxel not found.")
+        else:
+            self.go_to_line(line)
+
+    def find_next(self):
+        text = str(self.findEdit.text())
+        if not text:
+            return
+        start = self.listView.currentIndex().row() + 1
+        progress_dialog = QtGui.QProgressDialog(
+            "Searching...", "Cancel", 0, 1000, self)
+        progress_dialog.setWindowModality(QtCore.Qt.WindowModal)
+        progress_dialog.setMinimumDuration(500)
+
+        class Cancelled(Exception):
+            pass
+
+        def progress(done, total):
+            progress_dialog.setValue(int(1000 * done / total))
+            QtGui.QApplication.processEvents()
+            if progress_dialog.wasCanceled():
+                raise Cancelled()
+
+        try:
+            line = self.model.lines.find(text, start, progress)
+        except Cancelled:
+            return
+        finally:
+            progress_dialog.close()
+        if line is None:
+            QtGui.QMessageBox.information(self, "Source",
+                                          "Text not found: " + text)
+        else:
+            self.go_to_line(line)
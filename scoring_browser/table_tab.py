@@ -7,11 +7,112 @@
 #
 # This file may be distributed without limitation.
 #
-from PyQt4 import QtGui
-import math
+from PyQt4 import QtGui, QtCore
+import collections
 import numpy as np
 
 from slice_tab import SliceTab
+from heatmap import HeatmapColors
+from running_stats import RunningStatistics
+from export import write_csv_table, write_html_table
+
+
+class SliceTableModel(QtCore.QAbstractTableModel):
+    """ Read-only table model over the data of a 2D slice.
+
+    Values are read directly from the numpy array of the slice,
+    texts, tool tips and colours are produced only for the cells
+    requested by the view (i.e. the visible ones).
+    """
+    def __init__(self, tab, heatmap):
+        QtCore.QAbstractTableModel.__init__(self)
+        self.tab = tab
+        self.slice_data = None    # indexed [column, row]
+        self.color_indices = None
+        self.max_value = 1.0
+        self.relative = False
+        self.plane_name = "xy"
+
+        # Colours of the lookup table (built once)
+        self.backgrounds = [QtCore.QVariant(QtGui.QColor(*map(int, color)))
+                            for color in heatmap.background]
+        self.foregrounds = [QtCore.QVariant(QtGui.QColor(*map(int, color)))
+                            for color in heatmap.foreground]
+        self.foregrounds[HeatmapColors.NAN_INDEX] = QtCore.QVariant()
+
+    def set_slice(self, slice_data, color_indices, max_value, relative,
+                  plane_name):
+        '''Display new data.
+
+        :param color_indices: heatmap indices of all cells
+        '''
+        self.beginResetModel()
+        self.slice_data = slice_data
+        self.color_indices = color_indices
+        self.max_value = max_value
+        self.relative = relative
+        self.plane_name = plane_name
+        self.endResetModel()
+
+    def update_values(self, slice_data, color_indices, max_value):
+        '''Display changed values of the same slice.
+
+        Unlike set_slice, the model is not reset (the selection stays).
+        '''
+        self.slice_data = slice_data
+        self.color_indices = color_indices
+        self.max_value = max_value
+        self.dataChanged.emit(
+            self.index(0, 0),
+            self.index(self.rowCount() - 1, self.columnCount() - 1))
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+        if self.slice_data is None:
+            return 1
+        return self.slice_data.shape[1]
+
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+        if self.slice_data is None:
+            return 1
+        return self.slice_data.shape[0]
+
+    def headerData(self, section, orientation, role=QtCore.Qt.DisplayRole):
+        if role != QtCore.Qt.DisplayRole:
+            return QtCore.QVariant()
+        if self.slice_data is None:
+            return QtCore.QVariant("-")
+        if orientation == QtCore.Qt.Horizontal:
+            return QtCore.QVariant(self.plane_name[0] + " = " + str(section))
+        else:
+            return QtCore.QVariant(self.plane_name[1] + " = " + str(section))
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid():
+            return QtCore.QVariant()
+        if self.slice_data is None:
+            if role == QtCore.Qt.DisplayRole:
+                return QtCore.QVariant("No data.")
+            return QtCore.QVariant()
+
+        column, row = index.column(), index.row()
+        if role == QtCore.Qt.BackgroundRole:
+            return self.backgrounds[self.color_indices[column, row]]
+        elif role == QtCore.Qt.ForegroundRole:
+            return self.foregrounds[self.color_indices[column, row]]
+
+        value = self.slice_data[column, row]
+        shown = value / self.max_value if self.relative else value
+        if role == QtCore.Qt.DisplayRole:
+            return QtCore.QVariant(self.tab.format_value(shown))
+        elif role == QtCore.Qt.ToolTipRole:
+            return QtCore.QVariant(str(shown))
+        elif role == QtCore.Qt.UserRole:
+            return QtCore.QVariant(float(value))
+        return QtCore.QVariant()
 
 
 class TableTab(SliceTab):
@@ -19,9 +120,16 @@ class TableTab(SliceTab):
     def __init__(self, parent):
         SliceTab.__init__(self, parent)
 
-        self.table = QtGui.QTableWidget()
-        self.table.itemSelectionChanged.connect(self.update_statistics)
-        self.table.itemChanged.connect(self.on_item_changed)
+        self.heatmap = HeatmapColors()
+        self.model = SliceTableModel(self, self.heatmap)
+
+        # Heatmap indices of recently displayed slices
+        self._color_cache = collections.OrderedDict()
+        self.matrix_changed.connect(self._color_cache.clear)
+        self.table = QtGui.QTableView()
+        self.table.setModel(self.model)
+        self.table.selectionModel().selectionChanged.connect(
+            self.on_selection_changed)
         self.layout.addWidget(self.table)
 
         self.options = {
@@ -29,24 +137,31 @@ class TableTab(SliceTab):
             "digits" : 5
         }
 
+        # Statistics of the selection and the ranges included in it
+        self._stats = None
+        self._stats_ranges = []
+
         for signal in self.all_model_signals:
             signal.connect(self.update_table)
             signal.connect(self.update_statistics)
+        self.data_changed.connect(self.on_data_changed)
+        self.slice_data_changed.connect(self.refresh_values)
 
-    def on_item_changed(self, item):
-        # TODO: Implement
-        pass
+    def on_data_changed(self, region):
+        '''Forget colours of the changed slices.'''
+        if region is None:
+            self._color_cache.clear()
+            return
+        for axis, index in list(self._color_cache):
+            low, high = region[axis]
+            if low <= index < high:
+                del self._color_cache[(axis, index)]
 
-    def getCellValue(self, column, row, relative=False):
-        '''Get value for the table row & column.
-
-        Takes into account table orientation.
-        '''
-        index = self.slice.real_index(column, row)
-        if relative:
-            return self.matrix.relative_value_at(*index)
+    def on_selection_changed(self, selected, deselected):
+        if deselected.isEmpty():
+            self.update_statistics(selected)
         else:
-            return self.matrix.value_at(*index)
+            self.update_statistics()
 
     def format_value(self, value):
         digits = self.options.get("digits", 5)
@@ -55,35 +170,6 @@ class TableTab(SliceTab):
         else:
             return ("{:." + str(digits) + "f}").format(value)
 
-    def update_cell(self, column, row):
-        '''Set value and formatting of a single cell.'''
-        relativeValue = self.getCellValue(column, row, relative=True)
-        value = self.getCellValue(column, row, relative=False)
-        cellWidget = QtGui.QTableWidgetItem()
-        if self.relative:
-            cellWidget.setText(self.format_value(relativeValue))
-            cellWidget.setToolTip(str(relativeValue))
-        else:
-            cellWidget.setText(self.format_value(value))
-            cellWidget.setToolTip(str(value))
-        cellWidget.setData(32, value)
-        color = QtGui.QColor()
-        if np.isnan(relativeValue):
-            color.setRgbF(1.0, 1.0, 0.0)
-        else:
-            if relativeValue > 0:
-                color.setHslF(1.0, 1.0, 1.0 - relativeValue)
-            else:
-                color.setHslF(0.66, 1.0, 1.0 - abs(relativeValue))
-            if abs(relativeValue) > 0.33:
-                cellWidget.setForeground(QtGui.QColor(255, 255, 255))
-            else:
-                cellWidget.setForeground(QtGui.QColor(32, 32, 32))
-        cellWidget.setBackground(color)
-        
-        # cellWidget.palette = QtGui.QPalette(color)
-        self.table.setItem(row, column, cellWidget)
-
     def format_stats_number(self, number):
         if number > 10:
             return "{:.1f}".format(number)
@@ -96,63 +182,118 @@ class TableTab(SliceTab):
         else:
             return "{:.3e}".format(number)
 
-    def update_statistics(self):
+    @staticmethod
+    def _overlapping(ranges):
+        '''Whether any two of the (left, top, right, bottom) ranges overlap.'''
+        return any(not (a[2] < b[0] or b[2] < a[0] or
+                        a[3] < b[1] or b[3] < a[1])
+                   for i, a in enumerate(ranges) for b in ranges[:i])
+
+    def _add_ranges(self, stats, ranges):
+        '''Add values in the (left, top, right, bottom) ranges.'''
+        data = self.model.slice_data
+        if self._overlapping(ranges):
+            # Count each cell once
+            left = min(r[0] for r in ranges)
+            top = min(r[1] for r in ranges)
+            right = max(r[2] for r in ranges)
+            bottom = max(r[3] for r in ranges)
+            mask = np.zeros((right - left + 1, bottom - top + 1), dtype=bool)
+            for r in ranges:
+                mask[r[0] - left:r[2] - left + 1,
+                     r[1] - top:r[3] - top + 1] = True
+            stats.add(data[left:right + 1, top:bottom + 1][mask])
+        else:
+            for r in ranges:
+                stats.add(data[r[0]:r[2] + 1, r[1]:r[3] + 1])
+
+    def update_statistics(self, added=None):
         '''Fill status bar with interesting statistics.
 
-        The statistics summarize selected cells.'''
-        data = [self.getCellValue(i.column(), i.row())
-                for i in self.table.selectedIndexes()]
-
-        n = len(data)
-        total = sum(data)
-        text = "count = {}".format(n)
-        text += ", total = %s" % self.format_stats_number(total)
-        if n > 1:
-            mean = total / n
-            maximum = max(data)
-            minimum = min(data)
-            text += ", min = %s" % self.format_stats_number(minimum)
-            text += ", mean = %s" % self.format_stats_number(mean)
-            text += ", max = %s" % self.format_stats_number(maximum)
-            sum_square = sum(((value - mean) ** 2 for value in data))
-            stddev = math.sqrt(sum_square / (n - 1))
-            text += ", stdev = %s" % self.format_stats_number(stddev)
+        The statistics summarize selected cells. They are computed
+        from the rectangular selection ranges.
+
+        :param added: newly selected ranges (a QItemSelection), if the
+            selection only grew; only these are added to the result
+        '''
+        if self.model.slice_data is None:
+            return
+
+        def ranges_of(selection):
+            return [(r.left(), r.top(), r.right(), r.bottom())
+                    for r in selection]
+
+        new_ranges = ranges_of(added) if added is not None else []
+        if (added is not None and self._stats is not None and
+                not self._overlapping(self._stats_ranges + new_ranges)):
+            self._add_ranges(self._stats, new_ranges)
+            self._stats_ranges += new_ranges
+        else:
+            self._stats = RunningStatistics()
+            self._stats_ranges = ranges_of(
+                self.table.selectionModel().selection())
+            self._add_ranges(self._stats, self._stats_ranges)
+        stats = self._stats
+
+        text = "count = {}".format(stats.count)
+        text += ", total = %s" % self.format_stats_number(stats.total)
+        if stats.count > 1:
+            text += ", min = %s" % self.format_stats_number(stats.minimum)
+            text += ", mean = %s" % self.format_stats_number(stats.mean)
+            text += ", max = %s" % self.format_stats_number(stats.maximum)
+            text += ", stdev = %s" % self.format_stats_number(stats.stddev)
+        if stats.nan_count:
+            text += ", NaN count = {}".format(stats.nan_count)
         self.parent.set_status(text)
 
+    # How many slices to keep in the colour cache
+    COLOR_CACHE_SIZE = 16
+
+    def color_indices(self, data):
+        '''Heatmap indices for the current slice (cached).
+
+        The colours depend only on the relative value (in both modes).
+        '''
+        key = (self.slice.axis, self.slice_index)
+        if key in self._color_cache:
+            indices = self._color_cache.pop(key)
+        else:
+            indices = self.heatmap.indices(data / self.matrix.max_value)
+            if len(self._color_cache) >= self.COLOR_CACHE_SIZE:
+                self._color_cache.popitem(last=False)
+        self._color_cache[key] = indices
+        return indices
+
     def update_table(self):
         if self.matrix:
-            self.table.setColumnCount(self.column_count)
-            self.table.setRowCount(self.row_count)
-
-            for row in range(0, self.row_count):
-                self.table.setVerticalHeaderItem(
-                    row,
-                    QtGui.QTableWidgetItem(
-                        self.slice.plane_name[1] + " = " + str(row)))
-            self.table.setVerticalHeaderItem(self.row_count,
-                                             QtGui.QTableWidgetItem("Total"))
-
-            for column in range(0, self.column_count):
-                self.table.setHorizontalHeaderItem(
-                    column,
-                    QtGui.QTableWidgetItem(
-                        self.slice.plane_name[0] + " = " + str(column)))
-                for row in range(0, self.row_count):
-                    self.update_cell(column, row)
+            data = self.slice.data
+            self.model.set_slice(data, self.color_indices(data),
+                                 self.matrix.max_value, self.relative,
+                                 self.slice.plane_name)
         else:
-            self.table.setColumnCount(1)
-            self.table.setRowCount(1)
-            self.table.setItem(0, 0, QtGui.QTableWidgetItem("No data."))
-            self.table.setVerticalHeaderItem(0, QtGui.QTableWidgetItem("-"))
-            self.table.setHorizontalHeaderItem(0, QtGui.QTableWidgetItem("-"))
-        self.table.update()
+            self.model.set_slice(None, None, 1.0, self.relative, "xy")
+
+    def refresh_values(self):
+        '''Show changed values of the current slice.'''
+        data = self.slice.data
+        self.model.update_values(data, self.color_indices(data),
+                                 self.matrix.max_value)
+        self.update_statistics()
 
     def write_csv(self, fileName):
         if self.matrix:
-            with open(fileName, "w") as f:
-                for row in range(0, self.row_count):
-                    for column in range(0, self.column_count):
-                        f.write(str(self.getCellValue(column,
-                                                      row, self.relative)))
-                        f.write(",")
-                    f.write("\n")
+            data = self.slice.data
+            if self.relative:
+                data = data / self.matrix.max_value
+            write_csv_table(fileName, data)
+
+    def write_html(self, fileName):
+        '''Export the current table as HTML with the heatmap colours.'''
+        if not self.matrix:
+            return
+        data = self.slice.data
+        indices = self.color_indices(data)
+        if self.relative:
+            data = data / self.matrix.max_value
+        write_html_table(fileName, data, indices, self.heatmap,
+                         self.slice.plane_name, self.format_value)